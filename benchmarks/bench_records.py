@@ -0,0 +1,123 @@
+"""
+Memory benchmark of the availability records.
+
+Parses synthetic MockIkea availability responses for a list of items and
+measures the memory retained by the results when they are kept as the
+StoreAvailability/ItemLocation records used by check_stock, versus the
+plain dicts it used to build.
+
+Run from the repository root:
+
+    python benchmarks/bench_records.py --items 1000 --stores 50
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import mock_ikea  # noqa: E402
+from benchmarks.bench_stock_check import make_items  # noqa: E402
+from utils import check_stock, records, stock_parser  # noqa: E402
+
+
+def location_dict(item):
+    location = check_stock.get_item_location(item)
+    return {
+        'partNumber': item['partNumber'],
+        'qty': int(item['quantity']),
+        # a copy, the records share one interned string per location
+        'location': location.location[:1] + location.location[1:]
+    }
+
+
+def as_dicts(item_id, stores):
+    """The dict per store check_stock built before the records."""
+    out = []
+    for id, store in stores.items():
+        stock = store['stock']
+        loc = stock['findItList']['findIt']
+        if not isinstance(loc, list):
+            loc = [loc]
+        out.append({
+            'store_id': id,
+            'store_name': check_stock.get_store_name(id),
+            'item_id': item_id,
+            'available': int(stock['availableStock']),
+            'restockDate': stock.get('restockDate', 'N/A'),
+            'probability': stock['inStockProbabilityCode'],
+            'isMultiProduct': check_stock.str_to_bool(stock['isMultiProduct']),
+            'locations': [location_dict(item) for item in loc],
+            'forecast': None
+        })
+    return out
+
+
+def as_records(item_id, stores):
+    out = []
+    for id, store in stores.items():
+        stock = store['stock']
+        loc = stock['findItList']['findIt']
+        if not isinstance(loc, list):
+            loc = [loc]
+        out.append(records.StoreAvailability(
+            store_id=records.intern(id),
+            store_name=check_stock.get_store_name(id),
+            item_id=item_id,
+            available=int(stock['availableStock']),
+            restock_date=stock.get('restockDate', 'N/A'),
+            probability=records.intern(stock['inStockProbabilityCode']),
+            is_multi_product=check_stock.str_to_bool(stock['isMultiProduct']),
+            locations=tuple(check_stock.get_item_location(i) for i in loc),
+            forecast=None
+        ))
+    return out
+
+
+def measure(build, parsed):
+    """Returns the bytes retained by building every item with build."""
+    gc.collect()
+    tracemalloc.start()
+    results = [build(item_id, stores) for item_id, stores in parsed]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return retained
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Availability records memory benchmark')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--stores', type=int, default=50,
+                        help='stores per availability response')
+    args = parser.parse_args()
+
+    store_ids = ['{:03}'.format(900 + i) for i in range(args.stores)]
+    check_stock.ISC_CONFIG = {'store_ids': store_ids, 'country_code': 'us'}
+    # store names are not part of the comparison
+    check_stock.get_store_name = lambda store_id: None
+
+    mock = mock_ikea.MockIkea(store_ids)
+    parsed = []
+    for item in make_items(args.items):
+        data = mock.availability(item['id']).encode()
+        stores, _ = stock_parser.parse_local_stores(data, store_ids)
+        parsed.append((item['id'], stores))
+
+    dicts = measure(as_dicts, parsed)
+    recs = measure(as_records, parsed)
+    total = args.items * args.stores
+    print('{:>10} {:>12} {:>12}'.format('format', 'total (MB)', 'per store'))
+    print('{:>10} {:>12.2f} {:>12.0f}'.format(
+        'dict', dicts / 1024 / 1024, dicts / total))
+    print('{:>10} {:>12.2f} {:>12.0f}'.format(
+        'records', recs / 1024 / 1024, recs / total))
+    print('records use {:.0%} of the dict memory'.format(recs / dicts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Offline benchmark of `isc.py stock-check`.
+
+Runs check_stock.get against a local MockIkea server for synthetic lists of
+10, 100 and 1,000 items (a tenth of them multi-part articles) and reports
+the wall time, requests per second and peak RSS of each run. Every run
+happens in its own process so the peak RSS is per list size.
+
+Run from the repository root:
+
+    python benchmarks/bench_stock_check.py --latency 0.02 --workers 8
+    python benchmarks/bench_stock_check.py --latency 0.2 --rate-limit 20
+    python benchmarks/bench_stock_check.py --output base.json
+    python benchmarks/bench_stock_check.py --baseline base.json
+
+With --baseline the exit code is 1 when a run is slower than the baseline
+by more than --max-regression.
+
+Rate limiting is off unless --rate-limit is given, so the wall time
+measures the fetch, parse and report code rather than the token bucket.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import mock_ikea  # noqa: E402
+
+
+DEFAULT_SIZES = (10, 100, 1000)
+STORE_IDS = ['168', '215']
+
+
+def make_items(size):
+    """Returns a synthetic list of items, every tenth one multi-part."""
+    items = []
+    for i in range(size):
+        if i % 10 == 9:
+            item_id = 'S{:08}'.format(10000000 + i)
+        else:
+            item_id = '{:08}'.format(20000000 + i * 7)
+        items.append({
+            'id': item_id, 'qty': i % 3 + 1, 'notes': 'item {}'.format(i)})
+    return items
+
+
+def make_config(base_url, args):
+    from utils import transport
+
+    http = dict(transport.HTTP_DEFAULTS)
+    http['pool_size'] = max(http['pool_size'], args.workers)
+    http['rate_limit'] = args.rate_limit
+    return {
+        'store_ids': STORE_IDS,
+        'country_code': 'us',
+        'language_code': 'en',
+        'base_url': base_url,
+        'http': http,
+        'SECRET': None
+    }
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on macOS, kilobytes elsewhere
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def run_single(size, args):
+    """Runs one benchmark in this process and returns its results."""
+    from utils import check_stock, load_config
+
+    # load the store names before leaving the repository root
+    load_config.get_ikea_stores()
+
+    store_ids = STORE_IDS + ['{:03}'.format(900 + i)
+                             for i in range(args.stores - len(STORE_IDS))]
+    mock = mock_ikea.MockIkea(store_ids, args.facts_size, args.latency)
+    items = make_items(size)
+
+    with mock_ikea.MockIkeaServer(mock) as server, \
+            tempfile.TemporaryDirectory() as out_dir:
+        check_stock.configure(make_config(server.url, args))
+        os.chdir(out_dir)
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            check_stock.get(items, False, args.workers)
+        wall_time = time.perf_counter() - start
+        os.chdir(ROOT)
+
+    return {
+        'items': size,
+        'requests': mock.requests,
+        'bytes': mock.bytes_sent,
+        'wall_time': round(wall_time, 4),
+        'requests_per_second': round(mock.requests / wall_time, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def run_all(args):
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--single', str(size),
+                   '--workers', str(args.workers),
+                   '--latency', str(args.latency),
+                   '--stores', str(args.stores),
+                   '--facts-size', str(args.facts_size),
+                   '--rate-limit', str(args.rate_limit)]
+        output = subprocess.run(command, cwd=ROOT, check=True,
+                                stdout=subprocess.PIPE).stdout
+        results.append(json.loads(output))
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Prints the change against a baseline, returns False on regression."""
+    ok = True
+    previous = {r['items']: r for r in baseline}
+    for result in results:
+        if result['items'] not in previous:
+            continue
+        before = previous[result['items']]['wall_time']
+        change = (result['wall_time'] - before) / before
+        status = 'ok'
+        if change > max_regression:
+            status = 'REGRESSION'
+            ok = False
+        print('{:>6} items: {:+.1%} wall time vs baseline {}'.format(
+            result['items'], change, status))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline stock-check benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mock server latency in seconds')
+    parser.add_argument('--stores', type=int, default=50,
+                        help='stores per availability response')
+    parser.add_argument('--facts-size', type=int, default=64,
+                        help='length of the product descriptions')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='requests per second, 0 disables the limit')
+    parser.add_argument('--output', help='saves the results as JSON')
+    parser.add_argument('--baseline', help='results JSON to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed wall time increase, 0.2 = 20%%')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args.single, args)))
+        return
+
+    results = run_all(args)
+    print('{:>6} {:>9} {:>10} {:>10} {:>9}'.format(
+        'items', 'requests', 'wall (s)', 'req/s', 'rss (MB)'))
+    for r in results:
+        print('{items:>6} {requests:>9} {wall_time:>10.3f} '
+              '{requests_per_second:>10.1f} {peak_rss_mb:>9.1f}'.format(**r))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
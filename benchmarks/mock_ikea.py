@@ -0,0 +1,243 @@
+"""
+Local stand-in for the ikea.com endpoints used by isc.py.
+
+Serves synthetic, deterministic product and availability XML in the format
+of the real API, with a configurable latency and payload size. Articles
+starting with 'S' are multi-part products with two sub-parts.
+
+IrwWSInterestItemAdd requests add to in-memory shopping lists, see
+MockIkea.lists.
+
+Run it on its own with:
+
+    python benchmarks/mock_ikea.py --port 8000 --latency 0.05
+
+and point config.ini at it with `ikea_base_url = http://127.0.0.1:8000`.
+"""
+import argparse
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+PROBABILITIES = ('HIGH', 'MEDIUM', 'LOW')
+LOCATION_TYPES = ('BOX_SHELF', 'CONTACT_STAFF', 'SPECIALTY_SHOP', 'SELF_SERVE')
+
+
+def checksum(*values):
+    """Returns a stable pseudo random number for the values."""
+    return zlib.crc32('|'.join(values).encode())
+
+
+def get_parts(item_id):
+    """Returns the sub-part numbers of a multi-part article."""
+    if item_id.startswith('S'):
+        return ['9' + item_id[2:], '8' + item_id[2:]]
+    return []
+
+
+class MockIkea():
+    """
+    Synthetic ikea catalog.
+
+    Inputs:
+        store_ids [string]: The buCodes listed in availability responses
+        facts_size int: The length of the product description
+        latency float: Seconds to wait before answering a request
+    """
+    def __init__(self, store_ids, facts_size=64, latency=0.0):
+        self.store_ids = list(store_ids)
+        self.facts_size = facts_size
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        # {(storeId, listId): {partNumber: quantity}}
+        self.lists = {}
+        self._lock = threading.Lock()
+
+    def product(self, item_id):
+        price = checksum(item_id) % 50000 / 100
+        facts = ('facts ' * self.facts_size)[:self.facts_size]
+        return (
+            '<ir:ikea-rest xmlns:ir="http://www.ikea.com/rest">'
+            '<products><product><items><item>'
+            '<name>MOCK {0}</name><facts>{1}</facts>'
+            '<prices><normal>'
+            '<priceNormal unformatted="{2}">${2}</priceNormal>'
+            '</normal></prices>'
+            '<attributesItems>'
+            '<attributeItem><name>Color</name><value>white</value>'
+            '</attributeItem>'
+            '<attributeItem><name>Size</name><value>{3}x{3}</value>'
+            '</attributeItem>'
+            '</attributesItems>'
+            '</item></items></product></products></ir:ikea-rest>'
+            ).format(item_id, facts, price, checksum(item_id) % 9 + 1)
+
+    def find_it(self, part_number, store_id):
+        seed = checksum(part_number, store_id)
+        location_type = LOCATION_TYPES[seed % len(LOCATION_TYPES)]
+        out = (
+            '<findIt><partNumber>{}</partNumber><quantity>{}</quantity>'
+            '<type>{}</type>'
+            ).format(part_number, seed % 3 + 1, location_type)
+        if location_type == 'BOX_SHELF':
+            out += '<box>{:02}</box><shelf>{:02}</shelf>'.format(
+                seed % 40, seed % 9)
+        elif location_type == 'SPECIALTY_SHOP':
+            out += '<specialtyShop>Textiles</specialtyShop>'
+        return out + '</findIt>'
+
+    def local_store(self, item_id, store_id):
+        seed = checksum(item_id, store_id)
+        available = seed % 12
+        parts = get_parts(item_id)
+        out = (
+            '<localStore buCode="{}"><stock>'
+            '<partNumber>{}</partNumber>'
+            '<availableStock>{}</availableStock>'
+            '<inStockProbabilityCode>{}</inStockProbabilityCode>'
+            '<isMultiProduct>{}</isMultiProduct><findItList>'
+            ).format(store_id, item_id, available,
+                     PROBABILITIES[seed % len(PROBABILITIES)],
+                     'true' if parts else 'false')
+        if parts:
+            out += ''.join(self.find_it(part, store_id) for part in parts)
+        else:
+            out += self.find_it(item_id, store_id)
+        out += '</findItList>'
+        if available == 0:
+            out += '<restockDate>2030-01-{:02}</restockDate>'.format(
+                seed % 28 + 1)
+            out += '<forecasts>'
+            for day in range(3):
+                out += (
+                    '<forcast><validDate>2030-02-{:02}</validDate>'
+                    '<availableStock>{}</availableStock>'
+                    '<inStockProbabilityCode>HIGH</inStockProbabilityCode>'
+                    '</forcast>'
+                    ).format(day + 1, day * 2)
+            out += '</forecasts>'
+        return out + '</stock></localStore>'
+
+    def availability(self, item_id):
+        return (
+            '<ir:ikea-rest xmlns:ir="http://www.ikea.com/rest">'
+            '<availability>'
+            + ''.join(self.local_store(item_id, store_id)
+                      for store_id in self.store_ids)
+            + '</availability></ir:ikea-rest>'
+            )
+
+    def add_to_list(self, query):
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        try:
+            key = (params['storeId'], params['listId'])
+            part_number = params['partNumber']
+            quantity = int(params['quantity'])
+        except (KeyError, ValueError):
+            return 400, ''
+        with self._lock:
+            items = self.lists.setdefault(key, {})
+            items[part_number] = items.get(part_number, 0) + quantity
+        return 200, '<result>OK</result>'
+
+    def respond(self, path, query):
+        """
+        Returns the (status, body) of a request.
+        """
+        item_id = path.rstrip('/').rsplit('/', 1)[-1]
+        if path.endswith('/IrwWSInterestItemAdd'):
+            return self.add_to_list(query)
+        if '/catalog/products/' in path:
+            return 200, self.product(item_id)
+        if '/catalog/availability/' in path:
+            return 200, self.availability(item_id)
+        return 404, ''
+
+    def handle(self, path, query):
+        if self.latency:
+            time.sleep(self.latency)
+        status, body = self.respond(path, query)
+        body = body.encode()
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+        return status, body
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, avoid delayed ACK stalls
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, body = mock.handle(url.path, url.query)
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class MockIkeaServer():
+    """
+    Runs a MockIkea on a local port in a background thread.
+
+    Usable as a context manager; `url` is the base url to configure.
+    """
+    def __init__(self, mock, port=0):
+        self.mock = mock
+        self.httpd = ThreadingHTTPServer(
+            ('127.0.0.1', port), make_handler(mock))
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--store-ids', default='168,215',
+                        help='comma separated buCodes to serve')
+    parser.add_argument('--stores', type=int, default=50,
+                        help='number of stores in availability responses')
+    parser.add_argument('--facts-size', type=int, default=64,
+                        help='length of the product descriptions')
+    args = parser.parse_args()
+
+    store_ids = args.store_ids.split(',')
+    store_ids += ['{:03}'.format(900 + i)
+                  for i in range(args.stores - len(store_ids))]
+    mock = MockIkea(store_ids, args.facts_size, args.latency)
+    with MockIkeaServer(mock, args.port) as server:
+        print('Serving mock ikea on', server.url)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
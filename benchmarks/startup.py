@@ -0,0 +1,53 @@
+"""
+Compares the cost of loading the store map from stores.json against the
+compiled index, and times a few CLI invocations.
+
+Run from the repository root:
+
+    python benchmarks/startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import stores  # noqa: E402
+
+
+def best_of(fn, number=50, repeat=5):
+    """Returns the best per-call time in milliseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e3
+
+
+def time_command(args, repeat=5):
+    """Returns the best wall time of a command in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        elapsed = (time.perf_counter() - start) * 1e3
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    stores.compile_index()
+
+    print('Store map')
+    print('  json + index: {:8.3f} ms'.format(
+        best_of(lambda: stores.IkeaStores(compiled=False))))
+    print('  compiled:     {:8.3f} ms'.format(
+        best_of(lambda: stores.IkeaStores())))
+
+    print('CLI wall time')
+    for command in (['--help'], ['get-stores']):
+        print('  isc.py {:12} {:8.1f} ms'.format(
+            ' '.join(command),
+            time_command([sys.executable, 'isc.py'] + command)))
+
+
+if __name__ == '__main__':
+    main()
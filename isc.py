@@ -3,15 +3,86 @@ import json
 
 import click
 
-from utils import check_stock, stores, home_planner, add_to_list
+from utils import cache, load_config
 
 
 @click.group()
-def main():
+@click.option('--config-path',
+              default='config.ini',
+              help='Path to the configuration file',
+              show_default=True)
+@click.pass_context
+def main(ctx, config_path):
     """
     Simple CLI for working with the ikea API
     """
-    pass
+    # config.ini is loaded by the commands that need it
+    ctx.obj = load_config.IscContext(config_path)
+
+
+def set_archive(transport, record, replay):
+    """
+    Sets up --record / --replay for a command.
+    """
+    if record and replay:
+        raise click.UsageError('--record and --replay are mutually exclusive')
+    transport.set_archive(record=record, replay=replay)
+
+
+def check_stores(ikea_stores, stores_by_country):
+    """
+    Raises a UsageError if a store is not in the store map.
+    """
+    unknown = [
+        '{}:{}'.format(country_code, bu_code)
+        for country_code, bu_codes in stores_by_country.items()
+        for bu_code in bu_codes
+        if ikea_stores.lookup(bu_code, country_code) is None
+    ]
+    if unknown:
+        raise click.UsageError(
+            'Unknown stores: {}. See `isc.py get-stores`.'.format(
+                ', '.join(unknown)))
+
+
+def get_store_config(isc, store_list=None, all_stores=False):
+    """
+    Returns the config with the stores of --stores and --all-stores.
+    """
+    config = isc.config
+    if store_list:
+        config = dict(config)
+        config['stores_by_country'] = load_config.split_store_ids(
+            store_list.split(','), config['country_code'])
+        config['store_ids'] = config['stores_by_country'].get(
+            config['country_code'], [])
+    check_stores(isc.stores, config['stores_by_country'])
+    if all_stores:
+        # every availability response lists all stores of its country, so
+        # this needs no extra requests
+        config = dict(config)
+        config['stores_by_country'] = {
+            country_code: isc.stores.get_ids(country_code)
+            for country_code in config['stores_by_country']}
+        config['store_ids'] = config['stores_by_country'].get(
+            config['country_code'], [])
+    return config
+
+
+def load_items(stock_list, from_planner):
+    """
+    Returns the items of a STOCK_LIST or --from-planner document.
+    """
+    from utils import check_stock, profiling
+
+    if bool(stock_list) == bool(from_planner):
+        raise click.UsageError(
+            'Provide either a STOCK_LIST or --from-planner.')
+    if from_planner:
+        # parsed while the first items are already being fetched
+        return check_stock.load_planner(from_planner)
+    with profiling.phase('load_input_CSV'):
+        return check_stock.load_input_CSV(stock_list)
 
 
 @main.command()
@@ -25,7 +96,8 @@ def main():
               help='Language',
               show_default=True)
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
-def config(verbose, store_list, country, language):
+@click.pass_obj
+def config(isc, verbose, store_list, country, language):
     """
     Sets the target store(s) to search.
 
@@ -33,6 +105,8 @@ def config(verbose, store_list, country, language):
 
     Example: isc.py config 119,117
     """
+    from utils import stores, transport
+
     config = configparser.ConfigParser()
     config['CONFIG'] = {}
     config['CONFIG']['IKEA_COUNTRY_CODE'] = country
@@ -43,6 +117,10 @@ def config(verbose, store_list, country, language):
     config['SECRET']['IKEA_LIST_ID'] = ""
     config['SECRET']['IKEA_STORE_ID'] = ""
 
+    config['HTTP'] = {}
+    for key, default in transport.HTTP_DEFAULTS.items():
+        config['HTTP'][key.upper()] = str(default)
+
     formatted_store_list = store_list.split(',')
 
     valid_stores = []
@@ -64,8 +142,8 @@ def config(verbose, store_list, country, language):
                        + "IKEA_LANG_CODE: {}\n".format(language)
                        + "IKEA_STORES: {}\n".format(json.dumps(valid_stores))
                        )
-    f = open("config.ini", "+w")
-    config.write(f)
+    with open(isc.config_path, 'w') as f:
+        config.write(f)
 
 
 @main.command()
@@ -78,6 +156,7 @@ def get_stores(country):
     """
     Prints a list of stores for the target country.
     """
+    from utils import stores
 
     ikea_stores = stores.IkeaStores(store_map='stores.json',
                                     country_code=country)
@@ -97,7 +176,26 @@ def get_stores(country):
 
 
 @main.command()
-@click.argument('home_planner_file', type=click.Path(exists=True))
+@click.option('--store-map',
+              default='stores.json',
+              help='Path of the store map to compile.',
+              show_default=True)
+def compile_stores(store_map):
+    """
+    Compiles the store map into an index for faster startup.
+
+    The index is also rebuilt automatically whenever the store map changes.
+    """
+    from utils import stores
+
+    index = stores.compile_index(store_map)
+    click.echo('Compiled {} stores in {} countries to {}'.format(
+        len(index['store_map']), len(index['by_country']),
+        stores.index_path(store_map)))
+
+
+@main.command()
+@click.argument('home_planner_files', nargs=-1, required=True)
 @click.option('--output-path', '-p',
               default="planner_items.csv",
               help='Path of the parsed home planner output.',
@@ -106,65 +204,445 @@ def get_stores(country):
               default="csv",
               help='Content type of the parsed home planner output.',
               show_default=True)
+@click.option('--per-file', is_flag=True,
+              help='Writes one output per planner file, numbered after '
+                   'the output path, instead of one merged list.')
+@click.option('--jobs', '-j',
+              default=None,
+              type=click.IntRange(min=1),
+              help='Number of parser processes. [default: CPU count]')
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
-def parse_home_planner(verbose, home_planner_file, output_path, output_type):
+def parse_home_planner(verbose, home_planner_files, output_path, output_type,
+                       per_file, jobs):
     """
     Returns a Ikea Stock Checker list of items
     provide a home planner html document.
 
     At the time of writing this document is located in:
     'IKEA Home Planner_files/VPUISummary.html'
+
+    Several documents or glob patterns can be given. They are parsed in
+    parallel and merged into one list, items listed in more than one
+    document have their quantities summed.
     """
-    items = home_planner.parse(home_planner_file)
-    if output_type == "json":
-        home_planner.write_json(items, output_path)
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    from pathlib import Path
+    from utils import home_planner
+
+    paths, unmatched = home_planner.expand_paths(home_planner_files)
+    if unmatched:
+        raise click.BadParameter(
+            'No home planner files match {}'.format(', '.join(unmatched)),
+            param_hint='HOME_PLANNER_FILES')
+    jobs = min(jobs or os.cpu_count(), len(paths))
+
+    start = time.perf_counter()
+    if len(paths) == 1 and not per_file:
+        # a single document is streamed straight into the output
+        outputs = [output_path]
+        results = [home_planner.convert_file(
+            paths[0], output_path, output_type)]
+        total_items = results[0][0]
+    elif per_file:
+        output = Path(output_path)
+        outputs = [
+            str(output.with_name(
+                '{}_{}{}'.format(output.stem, n, output.suffix)))
+            for n in range(1, len(paths) + 1)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(
+                home_planner.convert_file, paths, outputs,
+                [output_type] * len(paths)))
+        total_items = sum(count for count, size in results)
     else:
-        home_planner.write_csv(items, output_path)
+        outputs = [output_path]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(home_planner.parse_file, paths))
+        items = home_planner.merge_items(items for items, size in results)
+        if output_type == "json":
+            home_planner.write_json(items, output_path)
+        else:
+            home_planner.write_csv(items, output_path)
+        total_items = len(items)
+    elapsed = time.perf_counter() - start
+
     if verbose:
         click.echo('\nCreated list of ikea items\n'
-                   + '\nInput: {}'.format(home_planner_file)
-                   + ' \nOutput: {}'.format(output_path)
+                   + '\nInput: {}'.format(', '.join(paths))
+                   + ' \nOutput: {}'.format(', '.join(outputs))
                    + ' \nContentType: {}\n'.format(output_type))
 
+    if len(paths) > 1:
+        total_bytes = sum(size for items, size in results)
+        click.echo(
+            'Parsed {} files ({:.1f} MB) into {} items in {:.2f}s: '
+            '{:.1f} files/s, {:.1f} MB/s with {} processes'.format(
+                len(paths), total_bytes / 1e6, total_items, elapsed,
+                len(paths) / elapsed, total_bytes / 1e6 / elapsed, jobs))
+
 
 @main.command()
-@click.argument('stock_list', type=click.Path(exists=True))
+@click.argument('stock_list', type=click.Path(exists=True), required=False)
+@click.option('--from-planner',
+              type=click.Path(exists=True, dir_okay=False),
+              help='Checks the items of a home planner html document'
+                   + ' instead of a CSV list.')
+@click.option('--stores', 'store_list',
+              help='Comma separated store IDs to check instead of the'
+                   + ' configured ikea_stores. Stores of other countries'
+                   + ' are written as country:buCode, e.g. 168,de:324.')
+@click.option('--all-stores', is_flag=True,
+              help='Checks every store of the configured countries and'
+                   + ' saves one ranking of the stores per country,'
+                   + ' out_all_stores_[country].csv, instead of a report'
+                   + ' per store. Needs numpy.')
+@click.option('--workers', '-w',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of concurrent requests to the ikea API.',
+              show_default=True)
+@click.option('--no-cache', is_flag=True,
+              help='Disables the on-disk product info cache.')
+@click.option('--refresh', is_flag=True,
+              help='Re-downloads all product info and updates the cache.')
+@click.option('--cache-dir',
+              default=cache.DEFAULT_CACHE_DIR,
+              help='Directory of the product info cache.',
+              show_default=True)
+@click.option('--cache-ttl',
+              default=cache.DEFAULT_TTL // 3600,
+              type=click.IntRange(min=0),
+              help='Hours before cached product info expires.',
+              show_default=True)
+@click.option('--cache-size',
+              default=cache.DEFAULT_MAX_ENTRIES,
+              type=click.IntRange(min=1),
+              help='Maximum number of cached products.',
+              show_default=True)
+@click.option('--record',
+              type=click.Path(file_okay=False),
+              help='Records all ikea API responses into this directory.'
+                   + ' Implies --no-cache.')
+@click.option('--replay',
+              type=click.Path(exists=True, file_okay=False),
+              help='Replays the ikea API responses recorded with --record'
+                   + ' instead of using the network. Implies --no-cache.')
+@click.option('--profile', is_flag=True,
+              help='Prints per-phase timings, request latencies and cache'
+                   + ' hit rates as JSON at the end of the run.')
+@click.option('--profile-output',
+              type=click.Path(dir_okay=False),
+              help='Writes the --profile JSON to this file instead.')
+@click.option('--cprofile',
+              type=click.Path(dir_okay=False),
+              help='Dumps cProfile stats of the main thread to this file.')
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
-def stock_check(verbose, stock_list):
+@click.pass_obj
+def stock_check(isc, verbose, stock_list, from_planner, store_list,
+                all_stores, workers, no_cache, refresh, cache_dir, cache_ttl,
+                cache_size, record, replay, profile, profile_output,
+                cprofile):
     """
     Checks if list of provided items are in stock
     """
-    items = check_stock.load_input_CSV(stock_list)
-    check_stock.get(items, verbose)
+    from utils import check_stock, profiling, transport
+
+    profiler = None
+    if profile or profile_output:
+        profiler = profiling.start()
+    if cprofile:
+        import cProfile
+        main_profiler = cProfile.Profile()
+        main_profiler.enable()
+
+    items = load_items(stock_list, from_planner)
+    check_stock.configure(get_store_config(isc, store_list, all_stores))
+    set_archive(transport, record, replay)
+
+    product_cache = None
+    if not (no_cache or record or replay):
+        product_cache = cache.ProductCache(cache_dir=cache_dir,
+                                           ttl=cache_ttl * 3600,
+                                           max_entries=cache_size,
+                                           refresh=refresh)
+
+    try:
+        check_stock.get(items, verbose, workers, product_cache, all_stores)
+    finally:
+        if product_cache:
+            product_cache.close()
+
+    if cprofile:
+        main_profiler.disable()
+        main_profiler.dump_stats(cprofile)
+    if profiler:
+        report = json.dumps(
+            profiler.report(check_stock.get_cache_stats(product_cache)),
+            indent=4)
+        if profile_output:
+            with open(profile_output, 'w') as f:
+                f.write(report)
+        else:
+            click.echo(report)
+
+
+@main.command()
+@click.argument('stock_list', type=click.Path(exists=True), required=False)
+@click.option('--from-planner',
+              type=click.Path(exists=True, dir_okay=False),
+              help='Plans the items of a home planner html document'
+                   + ' instead of a CSV list.')
+@click.option('--stores', 'store_list',
+              help='Comma separated store IDs to choose from instead of'
+                   + ' the configured ikea_stores.')
+@click.option('--all-stores', is_flag=True,
+              help='Chooses from every store of the country.')
+@click.option('--min-confidence',
+              default='MEDIUM',
+              type=click.Choice(['LOW', 'MEDIUM', 'HIGH'],
+                                case_sensitive=False),
+              help='Lowest in-stock confidence of the stock to count on.',
+              show_default=True)
+@click.option('--output', '-o',
+              default='out_trip_plan.csv',
+              type=click.Path(dir_okay=False),
+              help='Path of the plan.',
+              show_default=True)
+@click.option('--workers', '-w',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of concurrent requests to the ikea API.',
+              show_default=True)
+@click.option('--no-cache', is_flag=True,
+              help='Disables the on-disk product info cache.')
+@click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
+@click.pass_obj
+def plan_trip(isc, verbose, stock_list, from_planner, store_list, all_stores,
+              min_confidence, output, workers, no_cache):
+    """
+    Plans the fewest stores to visit to buy a list.
+
+    Splits the quantities among the stores, multi-part products are only
+    planned where all their sub-parts are in stock. Needs numpy.
+    """
+    from utils import check_stock, trip_planner
+
+    items = load_items(stock_list, from_planner)
+    config = get_store_config(isc, store_list, all_stores)
+    if len(config['stores_by_country']) > 1:
+        raise click.UsageError(
+            'plan-trip plans a trip in one country, got stores in {}.'.format(
+                ', '.join(config['stores_by_country'])))
+    check_stock.configure(config)
+
+    product_cache = None
+    if not no_cache:
+        product_cache = cache.ProductCache()
+    check_stock.PRODUCT_CACHE = product_cache
+    try:
+        products = check_stock.load_parse_all_products(
+            items, verbose, workers, show_stock=verbose)
+    finally:
+        if product_cache:
+            product_cache.close()
+
+    trip_planner.save_plan(products, output, min_confidence.upper())
+
+
+@main.command()
+@click.argument('stock_list', type=click.Path(exists=True))
+@click.option('--workers', '-w',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of concurrent requests to the ikea API.',
+              show_default=True)
+@click.option('--min-interval',
+              default=5.0,
+              type=click.FloatRange(min=0.1),
+              help='Minutes between polls of items that are LOW or out of'
+                   + ' stock close to their restock date.',
+              show_default=True)
+@click.option('--max-interval',
+              default=180.0,
+              type=click.FloatRange(min=0.1),
+              help='Minutes between polls of items at HIGH confidence in'
+                   + ' every store.',
+              show_default=True)
+@click.option('--events',
+              type=click.Path(dir_okay=False),
+              help='Appends every stock change as a JSON line to this file.')
+@click.option('--cycles',
+              default=0,
+              type=click.IntRange(min=0),
+              help='Stops after this many polls, 0 runs until interrupted.',
+              show_default=True)
+@click.option('--no-cache', is_flag=True,
+              help='Disables the on-disk product info cache.')
+@click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
+@click.pass_obj
+def watch(isc, verbose, stock_list, workers, min_interval, max_interval,
+          events, cycles, no_cache):
+    """
+    Keeps the stock-check reports of a list up to date.
+
+    Items are polled on an adaptive schedule: often when they are LOW or
+    out of stock close to their restock date, rarely when they are at HIGH
+    confidence everywhere. A store's out_*.csv is only rewritten, and the
+    change printed, when its stock changes.
+    """
+    from utils import check_stock
+    from utils import watch as watcher
+
+    if min_interval > max_interval:
+        raise click.BadParameter(
+            'must not be above --max-interval', param_hint='--min-interval')
+
+    check_stock.configure(isc.config)
+    product_cache = None
+    if not no_cache:
+        product_cache = cache.ProductCache()
+    check_stock.PRODUCT_CACHE = product_cache
+    check_stock.expire_product_info()
+
+    w = watcher.Watcher(check_stock.load_input_CSV(stock_list), verbose,
+                        workers, min_interval, max_interval, events)
+    try:
+        w.run(cycles)
+    finally:
+        if product_cache:
+            product_cache.close()
+
+
+@main.command()
+@click.option('--host',
+              default='127.0.0.1',
+              help='Address to listen on.',
+              show_default=True)
+@click.option('--port', '-p',
+              default=8080,
+              type=click.IntRange(min=0, max=65535),
+              help='Port to listen on.',
+              show_default=True)
+@click.option('--workers', '-w',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of concurrent requests to the ikea API per'
+                   + ' stock-check request.',
+              show_default=True)
+@click.option('--availability-ttl',
+              default=300,
+              type=click.IntRange(min=0),
+              help='Seconds before cached availability is fetched again.',
+              show_default=True)
+@click.option('--no-cache', is_flag=True,
+              help='Disables the on-disk product info cache.')
+@click.option('-v', '--verbose', is_flag=True,
+              help='Prints the stock of every fetched product.')
+@click.pass_obj
+def serve(isc, verbose, host, port, workers, availability_ttl, no_cache):
+    """
+    Serves stock checks as a local JSON API.
+
+    \b
+    POST /stock-check   {"items": [{"id": "...", "qty": 1, "notes": ""}]}
+    GET  /product-info?id=ITEM[&country=us]
+    GET  /stores?country=us[&id=BUCODE]
+    GET  /cache-stats
+    """
+    import contextlib
+    import os
+    from utils import check_stock, server
+
+    check_stock.configure(isc.config)
+    if not no_cache:
+        check_stock.PRODUCT_CACHE = cache.ProductCache()
+    httpd = server.make_server(host, port, workers, availability_ttl)
+    click.echo('Serving the isc API on http://{}:{}'.format(
+        *httpd.server_address[:2]))
+
+    with open(os.devnull, 'w') as devnull, contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            if check_stock.PRODUCT_CACHE:
+                check_stock.PRODUCT_CACHE.close()
 
 
 @main.command()
 @click.argument('stock_list', type=click.Path(exists=True))
 @click.option('--config-path',
-              default='config.ini',
-              help='Path to the configuration file',
+              default=None,
+              help='Path to the configuration file, overrides the global'
+                   + ' --config-path')
+@click.option('--record',
+              type=click.Path(file_okay=False),
+              help='Records all ikea API responses into this directory.')
+@click.option('--replay',
+              type=click.Path(exists=True, file_okay=False),
+              help='Replays the ikea API responses recorded with --record'
+                   + ' instead of using the network.')
+@click.option('--workers', '-w',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of items added at once.',
+              show_default=True)
+@click.option('--retries',
+              default=1,
+              type=click.IntRange(min=0),
+              help='Passes over the items that could not be added.',
+              show_default=True)
+@click.option('--sync', is_flag=True,
+              help='Only adds what the list is missing compared to the'
+                   + ' contents cached by the previous --sync.')
+@click.option('--reset-state', is_flag=True,
+              help='With --sync, forgets the cached list contents.')
+@click.option('--cache-dir',
+              default=cache.DEFAULT_CACHE_DIR,
+              help='Directory of the cached list contents.',
               show_default=True)
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
-def add_to_shopping_list(verbose, config_path, stock_list):
+@click.pass_obj
+def add_to_shopping_list(isc, verbose, config_path, stock_list, record,
+                         replay, workers, retries, sync, reset_state,
+                         cache_dir):
     """
     Adds the provided item list to a target shopping list.
     Requires config.ini to be configured properly.
 
     See the README for more details.
     """
+    from utils import add_to_list, check_stock, transport
+
+    set_archive(transport, record, replay)
+
+    if config_path:
+        isc = load_config.IscContext(config_path)
 
     config = configparser. RawConfigParser()
-    config.read(config_path)
+    config.read(isc.config_path)
     # check if target config file has been populated
     for secret in config['SECRET']:
         if not config['SECRET'][secret]:
             click.echo('\nERROR: {} not set in config.ini\n'.format(secret))
 
+    add_to_list.configure(isc.config)
     item_list = check_stock.load_input_CSV(stock_list)
     try:
-        if not add_to_list.add_all(item_list, verbose):
+        if sync:
+            added = add_to_list.sync(item_list, verbose, workers, retries,
+                                     cache_dir, reset_state)
+        else:
+            added = add_to_list.add_all(item_list, verbose, workers, retries)
+        if not added:
             click.echo('\nERROR: Error ocurred server side'
-                       + 'when adding item to list. \nPlease confirm'
+                       + ' when adding items to list. \nPlease confirm'
                        + ' the values in config.ini are correct\n')
     except KeyError:
         click.echo('\nERROR: config.ini has not been populated properly.'
@@ -0,0 +1,215 @@
+"""
+Checks trip_planner.plan against a brute force search over every
+combination of stores, on small random lists.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import itertools
+import random
+import unittest
+
+from utils import trip_planner
+from utils.records import ItemLocation, ProductInfo, StoreAvailability
+
+
+STORE_IDS = ['1', '2', '3', '4', '5', '6']
+PART_IDS = ['P1', 'P2', 'P3']
+PROBABILITIES = ('LOW', 'MEDIUM', 'HIGH')
+
+
+def make_avail(store_id, item_id, available, probability, parts=()):
+    """Returns a StoreAvailability, parts being (part number, qty)."""
+    if parts:
+        locations = [ItemLocation(part, qty, 'Aisle 1')
+                     for part, qty in parts]
+    else:
+        locations = [ItemLocation(item_id, 1, 'Aisle 1')]
+    return StoreAvailability(store_id, 'Store ' + store_id, item_id,
+                             available, None, probability, bool(parts),
+                             locations, None)
+
+
+def make_product(item_id, qty, stock, parts=()):
+    """
+    Returns a product as load_parse_all_products does.
+
+    stock is {(store id, article id): (available, probability)}, a store
+    without an entry for the article is missing from its availability.
+    """
+    def get_availability(article, article_parts=()):
+        return [make_avail(store_id, article, *stock[store_id, article],
+                           parts=article_parts)
+                for store_id in STORE_IDS if (store_id, article) in stock]
+
+    info = ProductInfo(item_id, '1.00', 'white', 'Test ' + item_id, '1x1')
+    return {
+        'id': item_id,
+        'qty_needed': qty,
+        'notes': '',
+        'info': info,
+        'availability': get_availability(item_id, parts),
+        'parts': {
+            part: {
+                'info': ProductInfo(part, '1.00', 'white', 'Part', '1x1'),
+                'availability': get_availability(part)
+            } for part, part_qty in parts
+        }
+    }
+
+
+def make_list(rng):
+    """
+    Returns a random list and its stock table. Multi-part products share
+    the sub-parts of PART_IDS, which can also be on the list on their own.
+    """
+    stock = {}
+    for store_id in STORE_IDS:
+        for article in PART_IDS + ['A', 'B', 'S1', 'S2']:
+            if rng.random() < 0.8:
+                stock[store_id, article] = (
+                    rng.randint(0, 4), rng.choice(PROBABILITIES))
+    products = []
+    for item_id in ['A', 'B', 'S1', 'S2'] + PART_IDS:
+        if rng.random() < 0.4:
+            continue
+        parts = ()
+        if item_id.startswith('S'):
+            parts = [(part, rng.randint(1, 2))
+                     for part in rng.sample(PART_IDS, rng.randint(1, 2))]
+        products.append(make_product(
+            item_id, rng.randint(1, 6), stock, parts))
+    return products, stock
+
+
+def get_supply(product, store_id, stock, min_code):
+    """How many of a product a store has, with its sub-parts counted
+    for this product alone."""
+    def confident(article):
+        available, probability = stock.get(
+            (store_id, article), (0, 'LOW'))
+        if trip_planner.CONFIDENCE_CODES[probability] < min_code:
+            return None
+        return available
+
+    supply = confident(product['id'])
+    if supply is None:
+        return 0
+    for avail in product['availability']:
+        if avail.store_id != store_id or not avail.is_multi_product:
+            continue
+        for loc in avail.locations:
+            part = confident(loc.part_number)
+            if part is None:
+                return 0
+            supply = min(supply, part // loc.qty)
+    return supply
+
+
+def brute_force(products, stock, min_confidence):
+    """
+    Returns the fewest stores covering what can be covered at all, with
+    the sub-part stock counted per product, so a lower bound of the plan.
+    """
+    min_code = trip_planner.CONFIDENCE_CODES[min_confidence]
+    supply = [[min(get_supply(prod, store_id, stock, min_code),
+                   prod['qty_needed'])
+               for prod in products] for store_id in STORE_IDS]
+    target = [min(prod['qty_needed'], sum(row[p] for row in supply))
+              for p, prod in enumerate(products)]
+    for size in range(len(STORE_IDS) + 1):
+        for stores in itertools.combinations(range(len(STORE_IDS)), size):
+            if all(sum(supply[s][p] for s in stores) >= target[p]
+                   for p in range(len(products))):
+                return size
+    return None
+
+
+def get_used(trip, stock):
+    """Returns {(store id, article id): units} the plan takes."""
+    used = {}
+    for s, store_id in enumerate(trip['store_ids']):
+        for p, (prod, qty, notes) in enumerate(trip['products']):
+            buy = int(trip['split'][s, p])
+            if not buy:
+                continue
+            avail = next(a for a in prod['availability']
+                         if a.store_id == store_id)
+            articles = [(prod['id'], 1)]
+            if avail.is_multi_product:
+                articles += [(loc.part_number, loc.qty)
+                             for loc in avail.locations]
+            for article, units in articles:
+                key = (store_id, article)
+                used[key] = used.get(key, 0) + buy * units
+    return used
+
+
+class TestPlan(unittest.TestCase):
+
+    def check_plan(self, products, stock, min_confidence):
+        trip = trip_planner.plan(products, STORE_IDS, min_confidence)
+        demand = [qty for prod, qty, notes in trip['products']]
+        bought = trip['split'].sum(axis=0)
+
+        # every unit is either bought or reported short
+        self.assertEqual(list(bought + trip['short']), demand)
+        # only the visited stores are bought from
+        visited = set(trip['stores'])
+        for s in range(len(STORE_IDS)):
+            if s not in visited:
+                self.assertFalse(trip['split'][s].any())
+        # no store sells more of an article than it has, sub-parts
+        # shared by several products included
+        for key, units in get_used(trip, stock).items():
+            self.assertLessEqual(units, stock[key][0], key)
+
+        fewest = brute_force(products, stock, min_confidence)
+        self.assertGreaterEqual(len(trip['stores']), fewest)
+        if trip['optimal']:
+            self.assertEqual(len(trip['stores']), fewest)
+        return trip
+
+    def test_random_lists(self):
+        rng = random.Random(1)
+        for run in range(300):
+            products, stock = make_list(rng)
+            for min_confidence in PROBABILITIES:
+                with self.subTest(run=run, min_confidence=min_confidence):
+                    self.check_plan(products, stock, min_confidence)
+
+    def test_shared_sub_part(self):
+        # P1 is on the list and in S1, one store has enough for either,
+        # only S1 must take it there
+        stock = {
+            ('1', 'P1'): (3, 'HIGH'),
+            ('1', 'S1'): (3, 'HIGH'),
+            ('2', 'P1'): (3, 'HIGH'),
+        }
+        products = [
+            make_product('P1', 3, stock),
+            make_product('S1', 3, stock, [('P1', 1)]),
+        ]
+        trip = self.check_plan(products, stock, 'HIGH')
+        self.assertEqual(list(trip['short']), [0, 0])
+        self.assertEqual(list(trip['split'][0]), [0, 3])
+        self.assertEqual(list(trip['split'][1]), [3, 0])
+        self.assertEqual(len(trip['stores']), 2)
+        self.assertEqual(trip['shared'], ['P1'])
+        self.assertFalse(trip['optimal'])
+
+    def test_left_out(self):
+        stock = {('1', 'A'): (2, 'HIGH')}
+        products = [make_product('A', 1, stock),
+                    make_product('S1', 1, stock, [('P1', 1)])]
+        products[1]['parts']['P1']['availability'] = None
+        trip = trip_planner.plan(products, STORE_IDS, 'HIGH')
+        self.assertEqual([prod['id'] for prod, qty, notes in
+                          trip['products']], ['A'])
+        self.assertEqual(
+            [(prod['id'], reason) for prod, qty, notes, reason in
+             trip['left_out']],
+            [('S1', 'sub-part P1 could not be fetched')])
+
+
+if __name__ == '__main__':
+    unittest.main()
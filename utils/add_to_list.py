@@ -1,59 +1,260 @@
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-from utils import load_config
+from termcolor import colored
 
+from utils import cache, transport
 
-# load the config
-ISC_CONFIG = load_config.isc_config().get()
 
+# concurrent add requests
+DEFAULT_WORKERS = 4
+# passes over the items that failed, on top of the transport retries
+DEFAULT_RETRIES = 1
 
-def add_item(part_number, quantity, verbose=False):
-    """Add an inventory item to a specified ikea shopping list"""
+# set by configure()
+ISC_CONFIG = None
 
-    if ISC_CONFIG['SECRET']:
-        SESSION_COOKIE = ISC_CONFIG['SECRET']['IKEA_SESSION_COOKIE']
-        STORE_ID = ISC_CONFIG['SECRET']['IKEA_STORE_ID']
-        LIST_ID = ISC_CONFIG['SECRET']['IKEA_LIST_ID']
-    else:
+
+def configure(isc_config):
+    """Sets the config used to reach the shopping list."""
+    global ISC_CONFIG
+    ISC_CONFIG = isc_config
+    transport.configure(**ISC_CONFIG['http'])
+
+
+def get_secret():
+    """Returns the session cookie, store and list ids of the target list."""
+    secret = ISC_CONFIG['SECRET']
+    if not secret or not all(secret.values()):
         print(
             '\nERROR: SECRETS have not been configured'
             ' in the provided config.ini\n')
         quit()
+    return secret
+
+
+def add_item(part_number, quantity, verbose=False):
+    """
+    Add an inventory item to a specified ikea shopping list
+
+    Returns: A dict with the item, whether it was added and the HTTP status
+    or error of the request. unknown is True when the request may have
+    been applied, e.g. it timed out after it was sent, so sending it again
+    could add the quantity twice.
+    """
+    secret = get_secret()
+    store_id = secret['IKEA_STORE_ID']
+    list_id = secret['IKEA_LIST_ID']
 
     headers = {
-        "cookie": SESSION_COOKIE,
+        "cookie": secret['IKEA_SESSION_COOKIE'],
     }
 
     query = {
         "partNumber": part_number,
         "langId": "-1",
-        "storeId": STORE_ID,
-        "listId": LIST_ID,
+        "storeId": store_id,
+        "listId": list_id,
         "quantity": quantity
     }
 
-    add_item_url = ("https://www.ikea.com"
+    add_item_url = (ISC_CONFIG['base_url']
                     + "/webapp/wcs/stores/servlet/IrwWSInterestItemAdd"
                     )
-    r = requests.get(add_item_url, params=query, headers=headers)
+    result = {'id': part_number, 'qty': quantity, 'added': False,
+              'unknown': False, 'status': None, 'error': None}
+    # the add is not idempotent, only retried when it cannot have applied
+    try:
+        r = transport.get(add_item_url, params=query, headers=headers,
+                          idempotent=False)
+    except requests.RequestException as e:
+        result['error'] = str(e)
+        result['unknown'] = not transport.is_unsent(e)
+        return result
+
+    result['status'] = r.status_code
+    if not r.ok:
+        result['error'] = 'HTTP {}'.format(r.status_code)
+        # the server may have applied the add before failing
+        result['unknown'] = r.status_code >= 500
+        return result
+
+    result['added'] = True
+    if verbose:
+        print("\nAdded"
+              + "\nitem: {0}".format(part_number)
+              + " \nquantity: {0}".format(quantity)
+              + " \nstore: {0}".format(store_id)
+              + " \nlist: {0}\n".format(list_id)
+              )
+    return result
+
+
+def add_items(item_list, verbose=False, workers=DEFAULT_WORKERS,
+              retries=DEFAULT_RETRIES):
+    """
+    Adds items to the shopping list over a pool of worker threads.
+
+    A failed item does not stop the others. Items that failed are tried
+    again for up to retries more passes, items whose add may have been
+    applied (unknown) are never sent again.
+
+    Returns: A list of results, see add_item, in the order of item_list.
+    The attempts key holds the number of passes used for the item.
+    """
+    get_secret()
+    results = [None] * len(item_list)
+    pending = list(range(len(item_list)))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for attempt in range(1, retries + 2):
+            futures = {
+                i: executor.submit(
+                    add_item, item_list[i]['id'], item_list[i]['qty'],
+                    verbose)
+                for i in pending
+            }
+            for i, future in futures.items():
+                results[i] = future.result()
+                results[i]['attempts'] = attempt
+            pending = [i for i in pending
+                       if not (results[i]['added'] or results[i]['unknown'])]
+            if not pending:
+                break
+
+    return results
+
+
+def print_summary(results):
+    """Prints how many items were added and why the others failed."""
+    added = [r for r in results if r['added']]
+    unknown = [r for r in results if r['unknown']]
+    failed = [r for r in results if not (r['added'] or r['unknown'])]
+    retried = [r for r in added if r['attempts'] > 1]
 
-    if r.status_code != "404":
-        if verbose:
-            print("\nAdded"
-                  + "\nitem: {0}".format(part_number)
-                  + " \nquantity: {1}".format(quantity)
-                  + " \nstore: {2}".format(STORE_ID)
-                  + " \nlist: {3}\n".format(LIST_ID)
-                  )
-        return True
+    print('\nAdded {} of {} items to the shopping list'.format(
+        len(added), len(results))
+        + (' ({} after a retry)'.format(len(retried)) if retried else ''))
+    if unknown:
+        print(colored(
+            'Not sent again, check the list for these, they may have been'
+            ' added:', 'yellow'))
+        for r in unknown:
+            print(colored(
+                '  {} (qty {}): {}'.format(r['id'], r['qty'], r['error']),
+                'yellow'))
+    if failed:
+        print(colored('Could not add:', 'red'))
+        for r in failed:
+            print(colored(
+                '  {} (qty {}): {}'.format(r['id'], r['qty'], r['error']),
+                'red'))
 
 
-def add_all(item_list, verbose=False):
+def add_all(item_list, verbose=False, workers=DEFAULT_WORKERS,
+            retries=DEFAULT_RETRIES):
     """
     Adds all items in a check_stock formatted csv file
     to an ikea shopping list.
+
+    Returns: True if every item was added
+    """
+    results = add_items(item_list, verbose, workers, retries)
+    print_summary(results)
+    return all(r['added'] for r in results)
+
+
+def state_path(cache_dir=cache.DEFAULT_CACHE_DIR):
+    """Returns the file caching the contents of the target list."""
+    secret = get_secret()
+    return os.path.join(cache_dir, 'lists', '{}-{}.json'.format(
+        secret['IKEA_STORE_ID'], secret['IKEA_LIST_ID']))
+
+
+def load_state(path):
+    """
+    Returns the cached quantity of each article on the list, empty when
+    the list was never synced.
     """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    """Atomically replaces the cached list contents."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def get_deltas(item_list, state):
+    """
+    Compares the wanted quantities with the list contents.
+
+    Duplicate articles in item_list are summed.
+
+    Returns: (adds, surplus), lists of {'id', 'qty'} with the quantities
+    to add, and the quantities the list holds beyond item_list
+    """
+    wanted = {}
     for item in item_list:
-        if not add_item(item['id'], item['qty'], verbose):
-            return False
-    return True
+        wanted[item['id']] = wanted.get(item['id'], 0) + item['qty']
+
+    adds = []
+    surplus = []
+    for item_id, qty in wanted.items():
+        delta = qty - state.get(item_id, 0)
+        if delta > 0:
+            adds.append({'id': item_id, 'qty': delta})
+        elif delta < 0:
+            surplus.append({'id': item_id, 'qty': -delta})
+    for item_id, qty in state.items():
+        if item_id not in wanted and qty > 0:
+            surplus.append({'id': item_id, 'qty': qty})
+    return adds, surplus
+
+
+def sync(item_list, verbose=False, workers=DEFAULT_WORKERS,
+         retries=DEFAULT_RETRIES, cache_dir=cache.DEFAULT_CACHE_DIR,
+         reset=False):
+    """
+    Brings the shopping list up to the quantities of item_list.
+
+    Only the difference with the list contents cached by previous syncs is
+    added, so re-running an unchanged list sends no requests. Articles are
+    only ever added; quantities the list holds beyond item_list are
+    reported to be removed by hand. Adds that may have been applied
+    (unknown) are cached as added, so no later sync adds them twice.
+
+    Returns: True if every needed item was added
+    """
+    path = state_path(cache_dir)
+    state = {} if reset else load_state(path)
+    adds, surplus = get_deltas(item_list, state)
+
+    results = add_items(adds, verbose, workers, retries)
+    for r in results:
+        if r['added'] or r['unknown']:
+            state[r['id']] = state.get(r['id'], 0) + r['qty']
+    save_state(path, state)
+
+    if results:
+        print_summary(results)
+    else:
+        print('\nThe shopping list is up to date')
+    if surplus:
+        print(colored(
+            'The list has more than needed, remove by hand:', 'yellow'))
+        for item in surplus:
+            print(colored('  {} (qty {})'.format(item['id'], item['qty']),
+                          'yellow'))
+    return all(r['added'] for r in results)
@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'ikea-stock-check')
+
+# one week
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 5000
+
+
+def get_stats(hits, misses, **extra):
+    """
+    Returns the hit/miss counters and hit rate of a cache as a dict.
+    """
+    lookups = hits + misses
+    stats = {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / lookups, 4) if lookups else None
+    }
+    stats.update(extra)
+    return stats
+
+
+class LRUCache():
+    """
+    Thread safe in-memory cache that holds at most `maxsize` entries,
+    evicting the least recently used entry first.
+
+    With a `ttl` in seconds, entries older than that are treated as
+    missing.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Returns the cached value or None.
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            value, stored_at = self._data[key]
+            expired = (self.ttl is not None
+                       and time.monotonic() - stored_at > self.ttl)
+            if expired:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes an entry, if cached.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns a one line summary of the cache usage.
+        """
+        return 'hits: {}, misses: {}, size: {}/{}'.format(
+            self.hits, self.misses, len(self), self.maxsize)
+
+    def get_stats(self):
+        """
+        Returns the cache usage as a dict.
+        """
+        return get_stats(self.hits, self.misses, size=len(self))
+
+
+class ProductCache():
+    """
+    Persistent product info cache.
+
+    Entries are keyed by country code, language code and item id, expire
+    after `ttl` seconds and the least recently used entries are evicted
+    once the cache holds more than `max_entries` products.
+    """
+    def __init__(self,
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 refresh=False
+                 ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'products.sqlite')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS products ('
+                ' country_code TEXT,'
+                ' language_code TEXT,'
+                ' item_id TEXT,'
+                ' info TEXT,'
+                ' fetched_at REAL,'
+                ' last_used REAL,'
+                ' PRIMARY KEY (country_code, language_code, item_id))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS products_last_used'
+                ' ON products (last_used)')
+
+    def get(self, country_code, language_code, item_id):
+        """
+        Returns the cached product info or None if it is missing or expired.
+        """
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        key = (country_code, language_code, item_id)
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT info, fetched_at FROM products'
+                ' WHERE country_code = ? AND language_code = ?'
+                ' AND item_id = ?', key).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._db.execute(
+                'UPDATE products SET last_used = ?'
+                ' WHERE country_code = ? AND language_code = ?'
+                ' AND item_id = ?', (now,) + key)
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, country_code, language_code, item_id, info):
+        """
+        Stores the product info.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)',
+                (country_code, language_code, item_id,
+                 json.dumps(info), now, now))
+
+    def get_stats(self):
+        """
+        Returns the cache usage as a dict.
+        """
+        return get_stats(self.hits, self.misses)
+
+    def evict(self):
+        """
+        Removes expired entries and the least recently used entries over
+        the size cap.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM products WHERE fetched_at < ?',
+                (time.time() - self.ttl,))
+            self._db.execute(
+                'DELETE FROM products WHERE rowid IN ('
+                ' SELECT rowid FROM products'
+                ' ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def close(self):
+        self.evict()
+        self._db.close()
@@ -1,16 +1,15 @@
 import csv
 import json
 
-import urllib.request
 import xmltodict as xml
 
-from termcolor import colored
-
-from utils import load_config
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers.expat import ExpatError
 
+from termcolor import colored
 
-# load the config
-ISC_CONFIG = load_config.isc_config().get()
+from utils import cache, home_planner, load_config, profiling, records
+from utils import stock_parser, transport
 
 
 # set defaults
@@ -19,34 +18,94 @@ PRODUCT_URL_SUFFIX = (
     'prices,parentCategories,allImages,attributes'
     )
 
-PRODUCT_BASE_URL = (
-    'https://www.ikea.com/{}/'.format(ISC_CONFIG['country_code'])
-    + '{}/catalog/products/'.format(ISC_CONFIG['language_code'])
-    )
-
-AVAILABILITY_BASE_URL = (
-    'https://www.ikea.com/{}'.format(ISC_CONFIG['country_code'])
-    + '/{}'.format(ISC_CONFIG['language_code'])
-    + '/iows/catalog/availability/'
-    )
+# set by configure()
+ISC_CONFIG = None
+# country code -> its language, stores and ikea API urls, see get_market
+MARKETS = {}
 
-PRODUCT_INFO = []
-PRODUCT_AVAILABILITY = []
+# in-memory caches keyed by (country code, language code, item id)
+PRODUCT_INFO = cache.LRUCache(maxsize=4096)
+PRODUCT_AVAILABILITY = cache.LRUCache(maxsize=4096)
 NOT_PUBLISHED = []
+# items whose requests failed after all retries
+FAILED = []
+
+# optional persistent product info cache, see utils.cache.ProductCache
+PRODUCT_CACHE = None
+# seconds before product info held in memory by a long running command is
+# read again from PRODUCT_CACHE, see expire_product_info
+PRODUCT_INFO_TTL = 60 * 60
 
 
-def get_store_name(store_id):
+def configure(isc_config):
+    '''
+    Sets the config used by all queries and builds the ikea API urls
+
+    Inputs:
+        isc_config dict: The loaded config, see load_config.isc_config
+    '''
+    global ISC_CONFIG, MARKETS
+
+    ISC_CONFIG = isc_config
+    stores_by_country = ISC_CONFIG.get('stores_by_country') or {
+        ISC_CONFIG['country_code']: ISC_CONFIG['store_ids']}
+    MARKETS = {}
+    for country_code, store_ids in stores_by_country.items():
+        language_code = ISC_CONFIG.get('language_codes', {}).get(
+            country_code, ISC_CONFIG['language_code'])
+        MARKETS[country_code] = {
+            'country_code': country_code,
+            'language_code': language_code,
+            'store_ids': list(store_ids),
+            'product_url': '{}/{}/{}/catalog/products/'.format(
+                ISC_CONFIG['base_url'], country_code, language_code),
+            'availability_url': (
+                '{}/{}/{}/iows/catalog/availability/'.format(
+                    ISC_CONFIG['base_url'], country_code, language_code))
+        }
+    transport.configure(**ISC_CONFIG['http'])
+
+
+def get_market(country_code=None):
+    '''
+    Returns the language, store IDs and ikea API urls of a country
+
+    Inputs:
+        country_code string: The country, defaults to the configured
+            country_code, or the first country with stores
+    '''
+    if country_code is None:
+        country_code = ISC_CONFIG['country_code']
+        if country_code not in MARKETS:
+            country_code = next(iter(MARKETS))
+    return MARKETS[country_code]
+
+
+def get_store_name(store_id, country_code=None):
     '''
     Gets the store name from the store ID
 
     Inputs:
         store_id int: The store ID
+        country_code string: The country of the store
 
     Returns: The store name
     '''
-    for n in ISC_CONFIG['store_names']:
-        if n['id'] == store_id:
-            return n['name']
+    store = load_config.get_ikea_stores().lookup(
+        store_id, country_code or ISC_CONFIG['country_code'])
+    if store:
+        return store['name']
+
+
+def to_item(item_id, qty, notes):
+    '''
+    Returns an input item from the ID, Quantity and Notes columns of a list
+    '''
+    return {
+        "id": item_id.replace(".", ""),
+        "qty": int(qty) if qty else 1,
+        "notes": notes or ''
+    }
 
 
 def load_input_CSV(in_file):
@@ -63,84 +122,129 @@ def load_input_CSV(in_file):
         for count, row in enumerate(reader):
             if count > 0:
                 # Process the rows to a dict
-                if row[1] == '':
-                    qty = 1
-                else:
-                    qty = int(row[1])
-                this_item = {
-                    "id": row[0].replace(".", ""),
-                    "qty": qty,
-                    "notes": row[2]
-                }
-
-                out.append(this_item)
+                out.append(to_item(row[0], row[1], row[2]))
 
     return out
 
 
-def get_product_info(item_id, verbose):
+def load_planner(in_file):
+    '''
+    Reads the items of a home planner html document
+
+    Returns: A generator of the same dictionaries as load_input_CSV. The
+    document is parsed while the items are consumed, so fetching can start
+    with the first rows.
+    '''
+    for item in home_planner.parse(in_file):
+        if item.get('ID'):
+            yield to_item(item['ID'], item.get('Quantity'), item.get('Notes'))
+
+
+def cache_key(item_id, country_code=None):
+    '''
+    Returns the in-memory cache key of an item in a country
+    '''
+    market = get_market(country_code)
+    return (market['country_code'], market['language_code'], item_id)
+
+
+def expire_product_info():
+    '''
+    Lets the in-memory product info expire, for commands that run for days
+
+    Once stale, product info is read again from PRODUCT_CACHE, which
+    fetches it again after its own TTL. Without a PRODUCT_CACHE it is
+    fetched again after the default product cache TTL.
+    '''
+    global PRODUCT_INFO
+    ttl = cache.DEFAULT_TTL
+    if PRODUCT_CACHE:
+        ttl = min(PRODUCT_INFO_TTL, PRODUCT_CACHE.ttl)
+    PRODUCT_INFO = cache.LRUCache(PRODUCT_INFO.maxsize, ttl=ttl)
+
+
+def get_product_info(item_id, verbose, country_code=None):
     '''
     Gets the product color, description, size, and price
 
     Inputs:
         item_id string: The item id
+        country_code string: The country of the product page and price
 
-    Returns: A dict with the product info
+    Returns: A ProductInfo record
         e.g.
-        {
-            'item_id': '01234567',
-            'price': 229.0,
-            'color': 'white',
-            'description': 'EXAMPLE product',
-            'size': '1x1'
-         }
+        ProductInfo(
+            item_id='01234567',
+            price=229.0,
+            color='white',
+            description='EXAMPLE product',
+            size='1x1'
+        )
     '''
 
     # If we already got info for this product, return it
-    for prod in PRODUCT_INFO:
-        if prod['item_id'] == item_id:
-            return prod
+    key = cache_key(item_id, country_code)
+    item_info = PRODUCT_INFO.get(key)
+    if item_info:
+        return item_info
+
+    if PRODUCT_CACHE:
+        item_info = PRODUCT_CACHE.get(*key)
+        if item_info:
+            item_info = records.ProductInfo.from_dict(item_info)
+            PRODUCT_INFO.set(key, item_info)
+            return item_info
 
-    url = "{}{}{}".format(PRODUCT_BASE_URL, item_id, PRODUCT_URL_SUFFIX)
+    url = "{}{}{}".format(
+        get_market(country_code)['product_url'], item_id, PRODUCT_URL_SUFFIX)
     try:
-        data = urllib.request.urlopen(url).read()
-        data = xml.parse(data)
-    except urllib.error.HTTPError as e:
+        with profiling.phase('product_info'):
+            data = transport.fetch(url)
+        with profiling.phase('product_info_parse'):
+            data = xml.parse(data)
+    except (transport.RequestError, ExpatError) as e:
         print('\nError encountered when querying url: {}\n'.format(url))
         print(e)
-        # pretty_print(data)
+        FAILED.append(item_id)
+        return False
 
     try:
         item = data['ir:ikea-rest']['products']['product']['items']['item']
-        item_info = {}
-        item_info['item_id'] = item_id
 
         # pricing
-        item_info['price'] = float(
+        price = float(
             item['prices']['normal']['priceNormal']['@unformatted'])
 
         # description & color
         try:
-            item_info['color'] = (
-                item['attributesItems']['attributeItem'][0]['value'])
+            color = item['attributesItems']['attributeItem'][0]['value']
         except:
-            item_info['color'] = ''
-        item_info['description'] = item['name'] + ' ' + item['facts']
+            color = ''
+        description = item['name'] + ' ' + item['facts']
 
         # size
         try:
-            item_info['size'] = (
-                item['attributesItems']['attributeItem'][1]['value'])
+            size = item['attributesItems']['attributeItem'][1]['value']
         except:
-            item_info['size'] = ''
+            size = ''
+
+        item_info = records.ProductInfo(
+            item_id=item_id,
+            price=price,
+            color=records.intern(color),
+            description=description,
+            size=records.intern(size)
+            )
         if verbose:
             print(
                 '\nRetrived info for product: ',
-                item_info['item_id'],
-                item_info['description'])
+                item_info.item_id,
+                item_info.description)
 
         # Save for later
-        PRODUCT_INFO.append(item_info)
+        PRODUCT_INFO.set(key, item_info)
+        if PRODUCT_CACHE:
+            PRODUCT_CACHE.set(*key, item_info.to_dict())
 
         return item_info
     except KeyError as e:
@@ -158,125 +262,147 @@ def get_product_info(item_id, verbose):
             return False
         except:
             print(colored(
-                    '\nError: ' + e
+                    '\nError: ' + str(e)
                     + ' for product: ' + item_id,
                     'red'
                    ))
+            FAILED.append(item_id)
+            return False
 
         # print(colored('\nQuitting.', 'red'))
         # quit()
 
 
-def get_product_availability(item_id, verbose):
+def get_product_availability(item_id, verbose, country_code=None):
     '''
     For a specified product ID, gets stock info at the requested stores
 
     Input:
         item_id string: The item ID
+        country_code string: The country of the stores
 
-    Returns: a list of dictionaries containing item availability
+    Returns: a list of StoreAvailability records
     '''
 
     # If we already got availability for this product, return it
-    for prod in PRODUCT_AVAILABILITY:
-        try:
-            if prod[0]['item_id'] == item_id:
-                return prod
-        except IndexError:
-            continue
+    key = cache_key(item_id, country_code)
+    out = PRODUCT_AVAILABILITY.get(key)
+    if out is not None:
+        return out
 
-    url = AVAILABILITY_BASE_URL + item_id
-    data = urllib.request.urlopen(url).read()
-    data = xml.parse(data)
-    availability = data['ir:ikea-rest']['availability']['localStore']
-    # pretty_print(availability)
+    market = get_market(country_code)
+    url = market['availability_url'] + item_id
+    try:
+        with profiling.phase('availability'):
+            data = transport.fetch(url)
+        # only materialize the configured stores
+        with profiling.phase('availability_parse'):
+            availability, stats = stock_parser.parse_local_stores(
+                data, market['store_ids'])
+    except (transport.RequestError, ExpatError) as e:
+        print('\nError encountered when querying url: {}\n'.format(url))
+        print(e)
+        FAILED.append(item_id)
+        return None
+    if verbose:
+        print(
+            '\nParsed availability for product:', item_id,
+            '- skipped {} of {} stores'.format(
+                stats['skipped_stores'], stats['stores']),
+            '({} elements, {} of {} bytes)'.format(
+                stats['skipped_elements'], stats['skipped_bytes'],
+                stats['total_bytes']))
 
     out = []
 
-    for id in ISC_CONFIG['store_ids']:
-        for store in availability:
-            if store['@buCode'] == id:
-                store_dict = {}
-                stock = store['stock']
-
-                # Store ID and name
-                store_dict['store_id'] = id
-                store_dict['store_name'] = get_store_name(id)
-
-                # basic availability info
-                store_dict['item_id'] = item_id
-                store_dict['available'] = int(stock['availableStock'])
-                if store_dict['available'] == 0:
-                    try:
-                        store_dict['restockDate'] = stock['restockDate']
-                    except KeyError:
-                        store_dict['restockDate'] = None
-                store_dict['probability'] = stock['inStockProbabilityCode']
-                store_dict['isMultiProduct'] = (
-                    str_to_bool(stock['isMultiProduct'])
-                    )
+    for id in market['store_ids']:
+        store = availability.get(id)
+        if store is None:
+            continue
 
-                # item location(s)
-                loc = stock['findItList']['findIt']
-                locations = []
-                if store_dict['isMultiProduct']:
-                    for item in loc:
-                        item_dict = get_item_location(item)
-                        locations.append(item_dict)
-                else:
-                    item_dict = get_item_location(loc)
-                    locations.append(item_dict)
-
-                store_dict['locations'] = locations
-
-                # forecast
-                try:
-                    if store_dict['restockDate']:
-                        store_dict['forecast'] = stock['forecasts']['forcast']
-                    else:
-                        store_dict['forecast'] = None
-                except KeyError:
-                    store_dict['restockDate'] = 'N/A'
-
-                out.append(store_dict)
-
-                # print the status to the terminal
-                confcolor = color_confidence(store_dict['probability'])
-                print(
-                    'At store:', store_dict['store_name'],
-                    'Qty:', colored(store_dict['available'], confcolor),
-                    'In-Stock Confidence:',
-                    colored(store_dict['probability'], confcolor))
-                if store_dict['available'] == 0:
-                    print('Restock date:', store_dict['restockDate'])
-                    if store_dict['forecast']:
-                        for f in store_dict['forecast']:
-                            confcolor = (
-                                color_confidence(f['inStockProbabilityCode'])
-                                )
-                            print('Forecast:')
-                            print(
-                                f['validDate'],
-                                'Qty:',
-                                colored(f['availableStock'], confcolor),
-                                'Confidence:',
-                                colored(f['inStockProbabilityCode'])
-                                )
-                    else:
-                        print(
-                            'Forecast:',
-                            colored(
-                                'No estimated restock date availabile',
-                                confcolor
-                                )
-                            )
+        stock = store['stock']
+        available = int(stock['availableStock'])
+        is_multi_product = str_to_bool(stock['isMultiProduct'])
+
+        # item location(s)
+        loc = stock['findItList']['findIt']
+        if is_multi_product:
+            locations = tuple(get_item_location(item) for item in loc)
+        else:
+            locations = (get_item_location(loc),)
+
+        # restock date & forecast
+        restock_date = 'N/A'
+        forecast = None
+        if available == 0:
+            restock_date = stock.get('restockDate')
+            try:
+                if restock_date:
+                    forecast = stock['forecasts']['forcast']
+                    if not isinstance(forecast, list):
+                        forecast = [forecast]
+            except (KeyError, TypeError):
+                restock_date = 'N/A'
+
+        avail = records.StoreAvailability(
+            store_id=records.intern(id),
+            store_name=get_store_name(id, market['country_code']),
+            item_id=item_id,
+            available=available,
+            restock_date=restock_date,
+            probability=records.intern(stock['inStockProbabilityCode']),
+            is_multi_product=is_multi_product,
+            locations=locations,
+            forecast=forecast
+            )
+        out.append(avail)
 
     # Save for later
-    PRODUCT_AVAILABILITY.append(out)
+    PRODUCT_AVAILABILITY.set(key, out)
 
     return out
 
 
+def print_availability(availability):
+    '''
+    Prints the stock of a product at each store
+
+    Inputs:
+        availability [StoreAvailability]: see get_product_availability,
+            None when it could not be fetched
+    '''
+    for avail in availability or []:
+        confcolor = color_confidence(avail.probability)
+        print(
+            'At store:', avail.store_name,
+            'Qty:', colored(avail.available, confcolor),
+            'In-Stock Confidence:',
+            colored(avail.probability, confcolor))
+        if avail.available == 0:
+            print('Restock date:', avail.restock_date)
+            if avail.forecast:
+                for f in avail.forecast:
+                    confcolor = (
+                        color_confidence(f['inStockProbabilityCode'])
+                        )
+                    print('Forecast:')
+                    print(
+                        f['validDate'],
+                        'Qty:',
+                        colored(f['availableStock'], confcolor),
+                        'Confidence:',
+                        colored(f['inStockProbabilityCode'])
+                        )
+            else:
+                print(
+                    'Forecast:',
+                    colored(
+                        'No estimated restock date availabile',
+                        confcolor
+                        )
+                    )
+
+
 def color_confidence(probability):
     '''
     Assigns Green/Yellow/Red colors to in-stock probability values
@@ -300,24 +426,24 @@ def get_item_location(item):
     Inputs:
         item dict: The dictionary containing the item
 
-    Returns: A dict with the item location
+    Returns: An ItemLocation record
     '''
-    item_dict = {}
-    item_dict['partNumber'] = item['partNumber']
-    item_dict['qty'] = int(item['quantity'])
-
     if item['type'] == 'BOX_SHELF':
         aisle = item['box']
         bin = item['shelf']
-        item_dict['location'] = 'Warehouse ' + aisle + '-' + bin
+        location = 'Warehouse ' + aisle + '-' + bin
     elif item['type'] == 'CONTACT_STAFF':
-        item_dict['location'] = 'Contact Staff'
+        location = 'Contact Staff'
     elif item['type'] == 'SPECIALTY_SHOP':
-        item_dict['location'] = item['specialtyShop'] + ' Dept.'
+        location = item['specialtyShop'] + ' Dept.'
     else:
-        item_dict['location'] = item['type']
+        location = item['type']
 
-    return item_dict
+    return records.ItemLocation(
+        part_number=item['partNumber'],
+        qty=int(item['quantity']),
+        location=records.intern(location)
+        )
 
 
 def str_to_bool(s):
@@ -347,31 +473,117 @@ def pretty_print(data):
     print(json.dumps(data, indent=1))
 
 
-def load_parse_all_products(items, verbose):
+def fetch_product(item_id, verbose, country_code=None):
+    '''
+    Gets the product info and, if the product is published, its availability
+
+    Inputs:
+        item_id string: The item id
+        country_code string: The country to check
+
+    Returns: A tuple of (product info, availability)
+    '''
+    item_info = get_product_info(item_id, verbose, country_code)
+    if not item_info:
+        return item_info, None
+    return item_info, get_product_availability(
+        item_id, verbose, country_code)
+
+
+def get_sub_parts(availability):
+    '''
+    Lists the part numbers of multi-part products
+
+    Inputs:
+        availability [dict]: The availability from get_product_availability
+
+    Returns [string]: The distinct part numbers in order of appearance
+    '''
+    parts = []
+    # availability is None when it could not be fetched
+    for avail in availability or []:
+        if avail.is_multi_product:
+            for loc in avail.locations:
+                if loc.part_number not in parts:
+                    parts.append(loc.part_number)
+    return parts
+
+
+def load_parse_all_products(items, verbose, workers=1, country_code=None,
+                            show_stock=True):
     '''
     Loads and parses all products
 
+    Product info and availability requests are fanned out over a pool of
+    worker threads. Each distinct item is only fetched once and the results
+    are assembled in input order.
+
+    The sub-parts of multi-part products are prefetched in the same pool as
+    soon as the availability of their product arrives, and are attached to
+    the product as product['parts'], so no requests are needed when the
+    report is written.
+
+    With show_stock, the stock of every product and sub-part is printed
+    once, in input order, see print_availability.
+
+    Inputs:
+        items [dict]: The items from load_input_CSV or load_planner
+        workers int: The number of concurrent fetch workers
+        country_code string: The country to check
+        show_stock bool: Prints the stock of the products
+
     Returns [dict]: A list of products
     '''
 
-    products = []
-    for item in items:
-        # Get product info
-        product = {}
-        product['id'] = item['id']
-        product['qty_needed'] = item['qty']
-        product['notes'] = item['notes']
-        item_info = get_product_info(item['id'], verbose)
-        if item_info:
-            product['info'] = item_info
-            product['availability'] = (
-                get_product_availability(item['id'], verbose)
-                )
-        else:
-            product['info'] = "Not available"
-            product['availability'] = "Not available"
-
-        products.append(product)
+    fetches = {}
+    ordered = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for item in items:
+            if item['id'] not in fetches:
+                fetches[item['id']] = executor.submit(
+                    fetch_product, item['id'], verbose, country_code)
+            ordered.append(item)
+
+        products = []
+        shown = set()
+        for item in ordered:
+            # Get product info
+            product = {}
+            product['id'] = item['id']
+            product['qty_needed'] = item['qty']
+            product['notes'] = item['notes']
+            item_info, availability = fetches[item['id']].result()
+            if show_stock and item['id'] not in shown:
+                shown.add(item['id'])
+                print_availability(availability)
+            if item_info:
+                product['info'] = item_info
+                product['availability'] = availability
+
+                # Prefetch the sub-parts of multi-part products
+                for part in get_sub_parts(availability):
+                    if part not in fetches:
+                        fetches[part] = executor.submit(
+                            fetch_product, part, verbose, country_code)
+            else:
+                product['info'] = "Not available"
+                product['availability'] = "Not available"
+
+            products.append(product)
+
+        for product in products:
+            if product['info'] == "Not available":
+                continue
+            product['parts'] = {}
+            for part in get_sub_parts(product['availability']):
+                info, availability = fetches[part].result()
+                if show_stock and part not in shown:
+                    shown.add(part)
+                    print_availability(availability)
+                product['parts'][part] = {
+                    'info': info,
+                    'availability': availability
+                }
 
     return products
 
@@ -388,40 +600,25 @@ def calc_total_price(products):
     total_price = 0.0
 
     for prod in products:
-        total_price = total_price + prod['info']['price'] * prod['qty_needed']
+        total_price = total_price + prod['info'].price * prod['qty_needed']
 
     return total_price
 
 
-def get_stock_confidence(products):
-    '''
-    Determines the in-stock probability for the entire list by store
-
-    Returns:
-        The stock confidence for each store
+def merge_confidence(confidence, probability):
     '''
-    confidence = []
-    for store in ISC_CONFIG['store_ids']:
-        store_dict = {}
-        store_dict['id'] = store
-        store_dict['confidence'] = 'HIGH'
-        confidence.append(store_dict)
+    Lowers a list's in-stock confidence by the probability of one item
 
-    for prod in products:
-        for store in prod['availability']:
-            store_id = store['store_id']
-            probability = store['probability']
-
-            if probability == 'LOW':
-                for store in confidence:
-                    if store['id'] == store_id:
-                        store['confidence'] = 'LOW'
-            elif confidence == 'MEDIUM':
-                for store in confidence:
-                    if store['id'] == store_id and \
-                       store['confidence'] != 'LOW':
-                        store['confidence'] = 'MEDIUM'
+    Inputs:
+        confidence string: The confidence so far, HIGH/MEDIUM/LOW
+        probability string: The in-stock probability of the item
 
+    Returns: The new confidence
+    '''
+    if probability == 'LOW':
+        return 'LOW'
+    elif probability == 'MEDIUM' and confidence != 'LOW':
+        return 'MEDIUM'
     return confidence
 
 
@@ -440,145 +637,362 @@ def save_file(filename, rows):
     print('\nSaved file', filename)
 
 
-def save_product_availability(products, verbose):
+def new_store_report(store_id, country_code=None):
+    '''
+    Returns an empty report for a store, see build_store_reports
+    '''
+    return {
+        'store_id': store_id,
+        'store_name': get_store_name(store_id, country_code),
+        'confidence': 'HIGH',
+        'meets_qty_reqs': True,
+        'total_items': 0,
+        'rows': []
+    }
+
+
+def get_part_availability(part, store_id):
+    '''
+    Gets the availability of a prefetched sub-part at a store
+
+    The sub-part's availability is indexed by store ID on first use.
+    '''
+    if 'by_store' not in part:
+        part['by_store'] = {
+            avail.store_id: avail for avail in part['availability']}
+    return part['by_store'][store_id]
+
+
+def build_store_reports(products, country_code=None):
     '''
-    Gets product info and availability and exports to CSV files
+    Builds the report of every configured store of a country in a single
+    pass over the products and their availability
+
+    Returns [dict]: One report per store, in the configured store order
+        e.g.
+        {
+            'store_id': '215',
+            'store_name': 'PA, South Philadelphia',
+            'confidence': 'HIGH',
+            'meets_qty_reqs': True,
+            'total_price': 229.0,
+            'total_items': 1,
+            'rows': [['01234567', 'EXAMPLE product', ...]]
+        }
     '''
+    market = get_market(country_code)
     total_price = calc_total_price(products)
-    stock_confidence = get_stock_confidence(products)
-    # pretty_print(products)
-
-    for store in ISC_CONFIG['store_ids']:
-        rows = []
-
-        total_items = 0
-        meets_qty_reqs = True
-
-        store_name = get_store_name(store)
-        rows.append(['Store', store_name])
-        rows.append(['Store ID', store])
-        for con in stock_confidence:
-            if con['id'] == store:
-                confidence = con['confidence']
-                break
-        rows.append(['In-Stock Confidence', confidence])
-        rows.append(['Total Price', total_price])
-        rows.append(['\n'])
-
-        rows.append(
-                    [
-                        'Part Number',
-                        'Description',
-                        'Location',
-                        'Qty Needed',
-                        'Qty Available',
-                        'In-Stock Confidence',
-                        'Color',
-                        'Size',
-                        'Unit Price',
-                        'Notes'
-                    ]
-            )
+    reports = {}
+    for store in market['store_ids']:
+        reports[store] = new_store_report(store, market['country_code'])
+        reports[store]['total_price'] = total_price
 
-        for prod in products:
-            for avail in prod['availability']:
-                if avail['store_id'] == store:
-                    thisrow = []
-
-                    if not avail['isMultiProduct']:
-                        # Not a multi-part product
-                        num_items = (
-                            avail['locations'][0]['qty'] * prod['qty_needed'])
-                        total_items = total_items + num_items
-
-                        notes0 = prod['notes']
-
-                        if prod['qty_needed'] > avail['available']:
-                            meets_qty_reqs = False
-                            notes0 = 'NOT ENOUGH QTY! ' + prod['notes']
-
-                        thisrow.append(prod['id'])
-                        thisrow.append(prod['info']['description'])
-                        thisrow.append(avail['locations'][0]['location'])
-                        thisrow.append(num_items)
-                        thisrow.append(avail['available'])
-                        thisrow.append(avail['probability'])
-                        thisrow.append(prod['info']['color'])
-                        thisrow.append(prod['info']['size'])
-                        thisrow.append(prod['info']['price'])
-                        thisrow.append(notes0)
-                        rows.append(thisrow)
-                    else:
-                        # Multi-part product
-
-                        notes1 = prod['notes']
-
-                        if prod['qty_needed'] > avail['available']:
-                            meets_qty_reqs = False
-                            notes1 = 'NOT ENOUGH QTY! ' + prod['notes']
-
-                        thisrow.append(prod['id'])
-                        thisrow.append(prod['info']['description'])
-                        thisrow.append('Multi-Part Product. See Below:')
-                        thisrow.append(prod['qty_needed'])
-                        thisrow.append(avail['available'])
-                        thisrow.append(avail['probability'])
-                        thisrow.append(prod['info']['color'])
-                        thisrow.append(prod['info']['size'])
-                        thisrow.append(prod['info']['price'])
-                        thisrow.append(notes1)
-                        rows.append(thisrow)
-
-                        for loc in avail['locations']:
-                            num_items = prod['qty_needed']*int(loc['qty'])
-                            total_items = total_items + num_items
-
-                            notes2 = 'Part of ' + prod['id']
-
-                            info = get_product_info(loc['partNumber'], verbose)
-                            avail = (
-                                      get_product_availability(
-                                          loc['partNumber'],
-                                          verbose
-                                        )
-                                    )
-                            for thisstore in avail:
-                                if thisstore['store_id'] == store:
-                                    avail = thisstore
-
-                            if num_items > avail['available']:
-                                meets_qty_reqs = False
-                                notes2 = 'NOT ENOUGH QTY! ' + notes2
-
-                            thisrow = []
-                            thisrow.append(loc['partNumber'])
-                            thisrow.append(info['description'])
-                            thisrow.append(loc['location'])
-                            thisrow.append(num_items)
-                            thisrow.append(avail['available'])
-                            thisrow.append(avail['probability'])
-                            thisrow.append(info['color'])
-                            thisrow.append(info['size'])
-                            thisrow.append(info['price'])
-                            thisrow.append(notes2)
-                            rows.append(thisrow)
-
-        rows.insert(4, ['Total Items', total_items])
-        rows.insert(3, ['Meets Qty Reqs', meets_qty_reqs])
-
-        save_file('out_' + str(store_name) + '.csv', rows)
+    for prod in products:
+        for avail in prod['availability']:
+            report = reports[avail.store_id]
+            rows = report['rows']
+            report['confidence'] = merge_confidence(
+                report['confidence'], avail.probability)
+
+            if not avail.is_multi_product:
+                # Not a multi-part product
+                num_items = avail.locations[0].qty * prod['qty_needed']
+                report['total_items'] += num_items
+
+                notes0 = prod['notes']
+
+                if prod['qty_needed'] > avail.available:
+                    report['meets_qty_reqs'] = False
+                    notes0 = 'NOT ENOUGH QTY! ' + prod['notes']
+
+                rows.append([
+                    prod['id'],
+                    prod['info'].description,
+                    avail.locations[0].location,
+                    num_items,
+                    avail.available,
+                    avail.probability,
+                    prod['info'].color,
+                    prod['info'].size,
+                    prod['info'].price,
+                    notes0
+                ])
+                continue
+
+            # Multi-part product
+            notes1 = prod['notes']
+
+            if prod['qty_needed'] > avail.available:
+                report['meets_qty_reqs'] = False
+                notes1 = 'NOT ENOUGH QTY! ' + prod['notes']
+
+            rows.append([
+                prod['id'],
+                prod['info'].description,
+                'Multi-Part Product. See Below:',
+                prod['qty_needed'],
+                avail.available,
+                avail.probability,
+                prod['info'].color,
+                prod['info'].size,
+                prod['info'].price,
+                notes1
+            ])
+
+            for loc in avail.locations:
+                num_items = prod['qty_needed'] * loc.qty
+                report['total_items'] += num_items
+
+                notes2 = 'Part of ' + prod['id']
+
+                part = prod['parts'][loc.part_number]
+                info = part['info']
+                part_avail = get_part_availability(part, avail.store_id)
+
+                if num_items > part_avail.available:
+                    report['meets_qty_reqs'] = False
+                    notes2 = 'NOT ENOUGH QTY! ' + notes2
+
+                rows.append([
+                    loc.part_number,
+                    info.description,
+                    loc.location,
+                    num_items,
+                    part_avail.available,
+                    part_avail.probability,
+                    info.color,
+                    info.size,
+                    info.price,
+                    notes2
+                ])
+
+    return [reports[store] for store in market['store_ids']]
+
+
+def get_report_rows(report):
+    '''
+    Lays out a store report as CSV rows
+    '''
+    rows = [
+        ['Store', report['store_name']],
+        ['Store ID', report['store_id']],
+        ['In-Stock Confidence', report['confidence']],
+        ['Meets Qty Reqs', report['meets_qty_reqs']],
+        ['Total Price', report['total_price']],
+        ['Total Items', report['total_items']],
+        ['\n'],
+        [
+            'Part Number',
+            'Description',
+            'Location',
+            'Qty Needed',
+            'Qty Available',
+            'In-Stock Confidence',
+            'Color',
+            'Size',
+            'Unit Price',
+            'Notes'
+        ]
+    ]
+    return rows + report['rows']
+
+
+def save_product_availability(products, verbose, country_code=None):
+    '''
+    Exports the product info and availability to CSV files
+
+    Works on the products returned by load_parse_all_products, including
+    their prefetched sub-parts, without making any requests.
+    '''
+    with profiling.phase('report_build'):
+        reports = build_store_reports(products, country_code)
+
+    with profiling.phase('report_write'):
+        for report in reports:
+            save_file('out_' + str(report['store_name']) + '.csv',
+                      get_report_rows(report))
     if verbose:
         print(colored('\nDone.', 'green'))
 
 
-def get(items, verbose):
-    products = load_parse_all_products(items, verbose)
-    # remove items that are no longer available
-    for item in NOT_PUBLISHED:
-        products = list(filter(lambda i: i['id'] != item, products))
-    save_product_availability(products, verbose)
+def get_cache_stats(product_cache=None):
+    '''
+    Returns the hit/miss counters of the product info and availability caches
+    '''
+    stats = {
+        'product_info': PRODUCT_INFO.get_stats(),
+        'availability': PRODUCT_AVAILABILITY.get_stats()
+    }
+    if product_cache:
+        stats['product_cache'] = product_cache.get_stats()
+    return stats
+
+
+def get_missing_reason(item_id, info, availability):
+    '''
+    Returns why an article is missing, or None if it was fetched
+    '''
+    if not info or info == "Not available":
+        if item_id in NOT_PUBLISHED:
+            return 'no longer sold'
+        return 'could not be fetched'
+    if availability is None:
+        return 'could not be fetched'
+    return None
+
+
+def get_left_out_reason(product):
+    '''
+    Returns why a product is left out of the reports, or None if the
+    product and its sub-parts were all fetched
+    '''
+    reason = get_missing_reason(
+        product['id'], product['info'], product['availability'])
+    if reason:
+        return reason
+    for part_number, part in product.get('parts', {}).items():
+        reason = get_missing_reason(
+            part_number, part['info'], part['availability'])
+        if reason:
+            return 'sub-part {} {}'.format(part_number, reason)
+    return None
+
+
+def is_complete(product):
+    '''
+    Returns False if the product, or one of its sub-parts, is not published
+    or could not be fetched
+    '''
+    return get_left_out_reason(product) is None
+
+
+def get_left_out(products):
+    '''
+    Returns [(item id, reason)]: The distinct products left out of the
+    reports, see get_left_out_reason
+    '''
+    left_out = {}
+    for product in products:
+        reason = get_left_out_reason(product)
+        if reason and product['id'] not in left_out:
+            left_out[product['id']] = reason
+    return list(left_out.items())
+
+
+def remove_failed(products, country_code=None):
+    '''
+    Removes the products that are no longer available or could not be
+    fetched, including multi-part products with such a sub-part, and
+    prints which were left out and why
+
+    Returns [dict]: The remaining products
+    '''
+    left_out = get_left_out(products)
+    if left_out:
+        print(colored(
+            '\nLeft out of the reports{}:'.format(
+                ' in ' + country_code if country_code else ''),
+            'red'))
+        for item_id, reason in left_out:
+            print(colored('  {}: {}'.format(item_id, reason), 'red'))
+    return [p for p in products if is_complete(p)]
+
+
+def save_reports(products, verbose, country_code=None, summary=False):
+    '''
+    Saves a report per store, or with summary a single ranking of the
+    stores, see store_matrix.save_summary
+    '''
+    if summary:
+        # numpy is only needed for the summary
+        from utils import store_matrix
+        with profiling.phase('report_build'):
+            store_matrix.save_summary(products, verbose, country_code)
+    else:
+        save_product_availability(products, verbose, country_code)
+
+
+def print_products(products):
+    '''
+    Prints the stock of the products and their sub-parts once each, in
+    order, see print_availability
+    '''
+    shown = set()
+    for product in products:
+        if product['info'] == "Not available":
+            continue
+        availabilities = [(product['id'], product['availability'])] + [
+            (part, product['parts'][part]['availability'])
+            for part in product.get('parts', {})]
+        for item_id, availability in availabilities:
+            if item_id not in shown:
+                shown.add(item_id)
+                print_availability(availability)
+
+
+def get_all_countries(items, verbose, workers=1, summary=False):
+    '''
+    Checks the items in the stores of every configured country
+
+    Each country needs its own product info, for its prices, and its own
+    availability, so the items are fetched once per country with the
+    countries fetched in parallel. The stock is printed per country, with
+    summary only if verbose, and the reports are written per store, or
+    with summary as one ranking per country.
+    '''
+    items = list(items)
+    with profiling.phase('fetch'), \
+            ThreadPoolExecutor(max_workers=len(MARKETS)) as executor:
+        fetches = {
+            country_code: executor.submit(
+                load_parse_all_products, items, verbose, workers,
+                country_code, False)
+            for country_code in MARKETS
+        }
+        products = {}
+        # printed one country at a time once fetched
+        for country_code, future in fetches.items():
+            products[country_code] = future.result()
+            if verbose or not summary:
+                print('\nStock in {}:'.format(country_code))
+                print_products(products[country_code])
+    with profiling.phase('report'):
+        for country_code, country_products in products.items():
+            save_reports(
+                remove_failed(country_products, country_code),
+                verbose, country_code, summary)
+
+
+def get(items, verbose, workers=1, product_cache=None, summary=False):
+    '''
+    Checks the items in the configured stores and saves the reports
+
+    Inputs:
+        summary bool: Saves one ranking of the stores per country instead
+            of a report per store. The stock printed per store is hidden
+            unless verbose.
+    '''
+    global PRODUCT_CACHE
+    PRODUCT_CACHE = product_cache
+
+    if len(MARKETS) == 1:
+        with profiling.phase('fetch'):
+            products = load_parse_all_products(
+                items, verbose, workers, show_stock=verbose or not summary)
+        products = remove_failed(products)
+        with profiling.phase('report'):
+            save_reports(products, verbose, summary=summary)
+    else:
+        get_all_countries(items, verbose, workers, summary)
+    if verbose:
+        print('\nProduct info cache', PRODUCT_INFO.stats())
+        print('Availability cache', PRODUCT_AVAILABILITY.stats())
+        if product_cache:
+            print('Product cache hits: {}, misses: {}'.format(
+                product_cache.hits, product_cache.misses))
 
 
 if __name__ == "__main__":
+    configure(load_config.isc_config().get())
     items = load_input_CSV('../in.csv')
     get(items, verbose=True)
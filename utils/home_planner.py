@@ -1,9 +1,22 @@
 import csv
+import glob
 import json
+import os
+import textwrap
 
+from html.parser import HTMLParser
 from pathlib import Path
 
-from bs4 import BeautifulSoup
+
+# characters of the planner document read per parser feed
+CHUNK_SIZE = 64 * 1024
+
+# td classes of the item cells and the item keys they fill
+ITEM_CELLS = {
+    'table_item_sku': 'ID',
+    'table_item_quantity': 'Quantity',
+    'table_item_longname': 'Notes'
+}
 
 
 def jpp(json_obj):
@@ -11,55 +24,244 @@ def jpp(json_obj):
     return json.dumps(json_obj, indent=4, sort_keys=True)
 
 
-def get_items(soup):
-    results = []
-    try:
-        item_tables = soup.find(id="summary_parent").find_all('table')
-        for table in item_tables:
-            rows = table.find_all('tr')
-            for row in rows:
-                tds = row.find_all('td')
-                item = {}
-                for td in tds:
-                    try:
-                        if td['class'][0] == 'table_item_sku':
-                            item['ID'] = td.string
-                        if td['class'][0] == 'table_item_quantity':
-                            item['Quantity'] = td.string
-                        if td['class'][0] == 'table_item_longname':
-                            item['Notes'] = td.div.contents[0].string
-                    except KeyError:
-                        continue
-                if item:
-                    results.append(item)
-        return results
-    except AttributeError:
+class PlannerParser(HTMLParser):
+    """
+    Event driven parser of the home planner item list.
+
+    Walks the document once and collects an item for every table row
+    inside the summary_parent element, from its sku, quantity and long
+    name cells. Finished items are appended to `items`; callers drain it
+    between feeds.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.items = []
+        self.found_summary = False
+        # tag of the summary_parent element and its nesting depth
+        self._summary_tag = None
+        self._summary_depth = 0
+        self._item = None
+        # item key of the cell being read, its text and the notes state
+        self._cell = None
+        self._text = []
+        self._in_div = False
+        self._child_tag = None
+        self._notes_done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self._summary_tag is None:
+            if dict(attrs).get('id') == 'summary_parent':
+                self.found_summary = True
+                self._summary_tag = tag
+                self._summary_depth = 1
+            return
+        if tag == self._summary_tag:
+            self._summary_depth += 1
+
+        if tag == 'tr':
+            # rows and cells may be left unclosed
+            self.end_cell()
+            self.end_row()
+            self._item = {}
+        elif tag == 'td' and self._item is not None:
+            self.end_cell()
+            classes = (dict(attrs).get('class') or '').split()
+            self._cell = ITEM_CELLS.get(classes[0]) if classes else None
+            self._text = []
+            self._in_div = False
+            self._child_tag = None
+            self._notes_done = False
+        elif self._cell == 'Notes' and not self._notes_done:
+            # the notes are the first child of the first div of the cell
+            if tag == 'div' and not self._in_div and not self._text:
+                self._in_div = True
+            elif self._in_div and self._child_tag is None:
+                if self._text:
+                    self._notes_done = True
+                else:
+                    self._child_tag = tag
+
+    def handle_endtag(self, tag):
+        if self._summary_tag is None:
+            return
+        if tag == self._summary_tag:
+            self._summary_depth -= 1
+            if self._summary_depth == 0:
+                self._summary_tag = None
+                self.end_cell()
+                self.end_row()
+                return
+
+        if tag == 'td':
+            self.end_cell()
+        elif tag == 'tr':
+            self.end_cell()
+            self.end_row()
+        elif self._cell == 'Notes' and self._in_div:
+            if self._text or tag == self._child_tag or tag == 'div':
+                self._notes_done = True
+
+    def handle_data(self, data):
+        if self._cell is None:
+            return
+        if self._cell == 'Notes':
+            if self._in_div and not self._notes_done:
+                self._text.append(data)
+        else:
+            self._text.append(data)
+
+    def end_cell(self):
+        if self._cell is not None and self._item is not None:
+            text = ''.join(self._text)
+            if text and not text.strip():
+                # collapse blank text like BeautifulSoup did
+                text = '\n' if '\n' in text else ' '
+            self._item[self._cell] = text or None
+        self._cell = None
+
+    def end_row(self):
+        if self._item:
+            self.items.append(self._item)
+        self._item = None
+
+
+def iter_items(chunks):
+    """
+    Yields the items of a home planner document read as an iterable of
+    text chunks, as soon as each table row is complete.
+    """
+    parser = PlannerParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.items
+        parser.items.clear()
+    parser.close()
+    yield from parser.items
+
+    if not parser.found_summary:
         print("ERROR - Expected contents not found in the provided file.")
 
 
+def read_chunks(f, size=CHUNK_SIZE):
+    """Yields a file in chunks of size characters."""
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
 def write_file(file_name, contents):
     """Writes a file."""
-    f = open(file_name, "w")
-    f.write(contents)
+    with open(file_name, "w") as f:
+        f.write(contents)
 
 
 def parse(input):
-    """Gets inventory items from home planner html doc."""
+    """
+    Gets inventory items from home planner html doc.
+
+    Returns a generator, the document is read while items are consumed.
+    """
     input = Path(input)
     if input.is_file():
-        html_doc = open(input, "r")
-        soup = BeautifulSoup(html_doc, 'html.parser')
-        return get_items(soup)
+        with open(input, "r") as html_doc:
+            yield from iter_items(read_chunks(html_doc))
+
+
+def expand_paths(patterns):
+    """
+    Returns the planner files matching a list of paths or glob patterns,
+    without duplicates and in the order given, and the paths and patterns
+    that match no file, as (paths, unmatched).
+    """
+    paths = []
+    unmatched = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        files = [path for path in matches if Path(path).is_file()]
+        if not files:
+            unmatched.append(pattern)
+        for path in files:
+            if path not in paths:
+                paths.append(path)
+    return paths, unmatched
+
+
+def parse_file(input):
+    """
+    Returns the items of a home planner html doc and its size in bytes.
+
+    A list rather than a generator, so it can be sent back from a worker
+    process.
+    """
+    return list(parse(input)), os.path.getsize(input)
+
+
+def convert_file(input, output, output_type):
+    """
+    Parses a home planner html doc into a csv or json list.
 
+    Returns the number of items and the size of the input in bytes.
+    """
+    count = 0
 
-def get_json(contens):
+    def counted(items):
+        nonlocal count
+        for item in items:
+            count += 1
+            yield item
+
+    if output_type == "json":
+        write_json(counted(parse(input)), output)
+    else:
+        write_csv(counted(parse(input)), output)
+    return count, os.path.getsize(input)
+
+
+def merge_items(item_lists):
+    """
+    Merges lists of items into one, in order of first appearance.
+
+    Items with the same ID are listed once with their quantities summed
+    and their distinct notes joined.
+    """
+    merged = {}
+    for items in item_lists:
+        for item in items:
+            item_id = item.get('ID')
+            if item_id not in merged:
+                merged[item_id] = dict(item)
+                continue
+            entry = merged[item_id]
+            try:
+                entry['Quantity'] = str(
+                    int(entry['Quantity']) + int(item['Quantity']))
+            except (KeyError, TypeError, ValueError):
+                print("WARNING - Could not sum the quantity of", item_id)
+            notes = item.get('Notes')
+            if notes and notes not in (entry.get('Notes') or '').split('; '):
+                entry['Notes'] = '; '.join(
+                    n for n in (entry.get('Notes'), notes) if n)
+    return list(merged.values())
+
+
+def get_json(contents):
     """Returns pretty printed JSON."""
     return jpp(contents)
 
 
 def write_json(contents, output):
-    """wries pretty printed JSON."""
-    write_file(output, jpp(contents))
+    """
+    Writes pretty printed JSON, one item at a time so contents can be a
+    generator.
+    """
+    with open(output, "w") as f:
+        separator = "[\n"
+        for item in contents:
+            f.write(separator + textwrap.indent(jpp(item), " " * 4))
+            separator = ",\n"
+        f.write("[]" if separator == "[\n" else "\n]")
 
 
 def write_csv(contents, output):
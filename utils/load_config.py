@@ -1,21 +1,49 @@
 import configparser
+import functools
 import json
 
 from utils import stores
 
 
-config = configparser.ConfigParser()
-ikea_stores = stores.IkeaStores()
+@functools.lru_cache(maxsize=None)
+def get_ikea_stores():
+    """
+    Returns the shared IkeaStores instance, loading it on first use.
+    """
+    return stores.IkeaStores()
+
+
+def split_store_ids(store_ids, country_code):
+    """
+    Groups store IDs by country.
+
+    Store IDs of other countries than country_code are written as
+    'country:buCode', e.g. 'de:324'.
+
+    Returns: A dict of country code to the list of its buCodes, in order
+    of first appearance
+    """
+    by_country = {}
+    for store_id in store_ids:
+        store_id = str(store_id)
+        country, _, bu_code = store_id.rpartition(':')
+        by_country.setdefault(country or country_code, []).append(bu_code)
+    return by_country
 
 
 class isc_config():
     def __init__(self, config_path=""):
+        self.config = configparser.ConfigParser()
         if config_path:
-            config.read(config_path)
+            self.config.read(config_path)
         else:
-            config.read('config.ini')
+            self.config.read('config.ini')
 
     def get(self):
+        # imported here so that loading the CLI does not import requests
+        from utils import transport
+
+        config = self.config
         loaded_config = {}
 
         try:
@@ -39,18 +67,58 @@ class isc_config():
             print('Using default language code: en')
             loaded_config['language_code'] = 'en'
 
-        loaded_config['store_names'] = (
-            ikea_stores.get_store_names(loaded_config['store_ids'])
-            )
+        loaded_config['stores_by_country'] = split_store_ids(
+            loaded_config['store_ids'], loaded_config['country_code'])
+        loaded_config['store_ids'] = loaded_config['stores_by_country'].get(
+            loaded_config['country_code'], [])
+
+        # languages of the other countries, default to language_code
+        loaded_config['language_codes'] = json.loads(
+            config.get('CONFIG', 'IKEA_LANG_CODES', fallback='{}'))
+
+        # only changed to point the tool at a local stand-in for ikea.com
+        loaded_config['base_url'] = config.get(
+            'CONFIG', 'IKEA_BASE_URL', fallback='https://www.ikea.com')
+
+        loaded_config['http'] = {}
+        for key, default in transport.HTTP_DEFAULTS.items():
+            loaded_config['http'][key] = type(default)(
+                config.get('HTTP', key, fallback=default))
 
         try:
-            loaded_config['SECRET']['IKEA_SESSION_COOKIE'] = (
-                config['SECRET']['IKEA_SESSION_COOKIE'])
-            loaded_config['SECRET']['IKEA_STORE_ID'] = (
-                config['SECRET']['IKEA_STORE_ID'])
-            loaded_config['SECRET']['IKEA_LIST_ID'] = (
-                config['SECRET']['IKEA_LIST_ID'])
+            loaded_config['SECRET'] = {
+                'IKEA_SESSION_COOKIE': config['SECRET']['IKEA_SESSION_COOKIE'],
+                'IKEA_STORE_ID': config['SECRET']['IKEA_STORE_ID'],
+                'IKEA_LIST_ID': config['SECRET']['IKEA_LIST_ID']
+            }
         except KeyError:
             loaded_config['SECRET'] = None
 
         return loaded_config
+
+
+class IscContext():
+    """
+    Configuration shared by the CLI commands.
+
+    config.ini is only read the first time a command asks for it.
+    """
+    def __init__(self, config_path='config.ini'):
+        self.config_path = config_path
+        self._config = None
+
+    @property
+    def config(self):
+        """
+        Returns the loaded config.ini, see isc_config.get.
+        """
+        if self._config is None:
+            self._config = isc_config(self.config_path).get()
+        return self._config
+
+    @property
+    def stores(self):
+        """
+        Returns the shared IkeaStores instance.
+        """
+        return get_ikea_stores()
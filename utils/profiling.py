@@ -0,0 +1,135 @@
+import contextlib
+import math
+import threading
+import time
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# the active Profiler, see start()
+PROFILER = None
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+class Profiler():
+    """
+    Collects per-phase wall times and per-endpoint request latencies.
+
+    Phases that run on the fetch workers (product info, availability) add
+    up the time spent in every thread, so they can exceed the wall time of
+    the enclosing 'fetch' phase.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            phase['seconds'] += seconds
+            phase['calls'] += 1
+
+    def add_request(self, endpoint, seconds, size):
+        with self._lock:
+            stats = self.requests.setdefault(
+                endpoint, {'latencies': [], 'bytes': 0})
+            stats['latencies'].append(seconds)
+            stats['bytes'] += size
+
+    def get_endpoint_report(self, stats):
+        latencies = sorted(s * 1000 for s in stats['latencies'])
+        histogram = {}
+        for bound in LATENCY_BUCKETS:
+            histogram['<={}ms'.format(bound)] = 0
+        histogram['>{}ms'.format(LATENCY_BUCKETS[-1])] = 0
+        for latency in latencies:
+            for bound in LATENCY_BUCKETS:
+                if latency <= bound:
+                    histogram['<={}ms'.format(bound)] += 1
+                    break
+            else:
+                histogram['>{}ms'.format(LATENCY_BUCKETS[-1])] += 1
+
+        return {
+            'requests': len(latencies),
+            'bytes': stats['bytes'],
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'histogram': histogram
+        }
+
+    def report(self, caches=None):
+        """
+        Returns the collected measurements as a JSON serializable dict.
+        """
+        with self._lock:
+            phases = {
+                name: {
+                    'seconds': round(phase['seconds'], 4),
+                    'calls': phase['calls']
+                }
+                for name, phase in self.phases.items()
+            }
+            endpoints = {
+                endpoint: self.get_endpoint_report(stats)
+                for endpoint, stats in self.requests.items()
+            }
+        return {
+            'wall_time': round(time.perf_counter() - self.started, 4),
+            'phases': phases,
+            'endpoints': endpoints,
+            'bytes_transferred': sum(
+                e['bytes'] for e in endpoints.values()),
+            'caches': caches or {}
+        }
+
+
+def start():
+    """
+    Starts collecting measurements and returns the Profiler.
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+def stop():
+    global PROFILER
+    PROFILER = None
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Times the enclosed block as a phase of the active profiler, if any.
+    """
+    if PROFILER is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.add_phase(name, time.perf_counter() - started)
+
+
+def record_request(endpoint, seconds, size):
+    """
+    Records a request with the active profiler, if any.
+    """
+    if PROFILER is not None:
+        PROFILER.add_request(endpoint, seconds, size)
@@ -0,0 +1,79 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlencode
+
+
+# response headers kept in the archive
+KEPT_HEADERS = ('Content-Type', 'Retry-After')
+
+
+class MissingRecording(requests.RequestException):
+    """Raised when a replayed request is not in the archive."""
+
+
+def request_key(url, params=None):
+    """
+    Returns the archive key of a request, the sha1 of its url and sorted
+    query parameters. Headers such as the session cookie are not part of
+    the key.
+    """
+    if params:
+        url = url + '?' + urlencode(sorted(params.items()))
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class Archive():
+    """
+    Directory of recorded responses, one gzipped JSON file per request.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def entry_path(self, url, params=None):
+        return os.path.join(
+            self.path, request_key(url, params) + '.json.gz')
+
+    def save(self, url, params, response):
+        """
+        Records a response.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entry = {
+            'url': url,
+            'params': params,
+            'status': response.status_code,
+            'headers': {
+                name: response.headers[name]
+                for name in KEPT_HEADERS if name in response.headers
+            },
+            'body': base64.b64encode(response.content).decode('ascii')
+        }
+        with gzip.open(self.entry_path(url, params), 'wt') as f:
+            json.dump(entry, f)
+
+    def load(self, url, params=None):
+        """
+        Returns the recorded response of a request as a requests.Response.
+
+        Raises MissingRecording if the request was never recorded.
+        """
+        try:
+            with gzip.open(self.entry_path(url, params), 'rt') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            raise MissingRecording(
+                'No recorded response for {} in {}'.format(url, self.path))
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = base64.b64decode(entry['body'])
+        return response
@@ -0,0 +1,70 @@
+import sys
+
+from collections import namedtuple
+
+
+def intern(value):
+    """
+    Interns short, frequently repeated strings such as store IDs and
+    probability codes so every record shares a single copy.
+    """
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
+def as_dict(value):
+    """
+    Returns records, also when nested in lists or tuples, as plain dicts
+    and lists, e.g. to serialize them as JSON.
+    """
+    if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {k: as_dict(v) for k, v in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [as_dict(v) for v in value]
+    return value
+
+
+class ProductInfo(namedtuple('ProductInfo', [
+        'item_id',
+        'price',
+        'color',
+        'description',
+        'size'])):
+    """The color, description, size and price of a product"""
+    __slots__ = ()
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class ItemLocation(namedtuple('ItemLocation', [
+        'part_number',
+        'qty',
+        'location'])):
+    """Where a product or sub-part is picked up in a store"""
+    __slots__ = ()
+
+
+class StoreAvailability(namedtuple('StoreAvailability', [
+        'store_id',
+        'store_name',
+        'item_id',
+        'available',
+        'restock_date',
+        'probability',
+        'is_multi_product',
+        'locations',
+        'forecast'])):
+    """
+    The stock of a product at one store.
+
+    restock_date is None when the product is out of stock without a known
+    restock date and 'N/A' when no forecast is available. forecast is a
+    list of the raw forecast entries or None.
+    """
+    __slots__ = ()
@@ -0,0 +1,241 @@
+import collections
+import json
+import time
+import traceback
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from utils import cache, check_stock, load_config, records, transport
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# seconds before cached availability is fetched again
+DEFAULT_AVAILABILITY_TTL = 300
+# largest accepted request body
+MAX_BODY_SIZE = 1024 * 1024
+# seconds between two evictions of the product info cache, see ApiServer
+EVICT_INTERVAL = 600
+
+# keys of the item rows of a store report, see check_stock.get_report_rows
+ITEM_FIELDS = (
+    'part_number',
+    'description',
+    'location',
+    'qty_needed',
+    'qty_available',
+    'confidence',
+    'color',
+    'size',
+    'unit_price',
+    'notes'
+)
+
+
+class ApiError(Exception):
+    """An error answered with an HTTP status and a JSON message."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def get_param(query, name, default=None):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise ApiError(400, 'Missing query parameter: {}'.format(name))
+        return default
+    return values[0]
+
+
+def get_items(body):
+    """Returns the stock-check items of a request body."""
+    try:
+        return [
+            check_stock.to_item(
+                str(item['id']), item.get('qty'), item.get('notes'))
+            for item in body['items']
+        ]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise ApiError(
+            400, 'Expected {"items": [{"id": ..., "qty": ..., "notes": ...}]}')
+
+
+def stock_check(body, workers):
+    """
+    Returns the store reports of a list of items, for the stores of every
+    configured country.
+
+    Items that are not published or could not be fetched are left out of
+    the reports and listed as unavailable.
+    """
+    items = get_items(body)
+    stores = []
+    unavailable = set()
+    for country_code in check_stock.MARKETS:
+        products = check_stock.load_parse_all_products(
+            items, False, workers, country_code, show_stock=False)
+        unavailable.update(
+            p['id'] for p in products if not check_stock.is_complete(p))
+        products = [p for p in products if check_stock.is_complete(p)]
+
+        for report in check_stock.build_store_reports(
+                products, country_code):
+            stores.append({
+                'store_id': report['store_id'],
+                'store_name': report['store_name'],
+                'country_code': country_code,
+                'confidence': report['confidence'],
+                'meets_qty_reqs': report['meets_qty_reqs'],
+                'total_price': report['total_price'],
+                'total_items': report['total_items'],
+                'items': [dict(zip(ITEM_FIELDS, row))
+                          for row in report['rows']]
+            })
+    return {'stores': stores, 'unavailable': sorted(unavailable)}
+
+
+def product_info(query):
+    """Returns the info and availability of one product in a country."""
+    item_id = get_param(query, 'id').replace('.', '')
+    country = get_param(
+        query, 'country', check_stock.get_market()['country_code'])
+    if country not in check_stock.MARKETS:
+        raise ApiError(404, 'No configured stores in {}'.format(country))
+    info, availability = check_stock.fetch_product(item_id, False, country)
+    if not info:
+        raise ApiError(404, 'Product not available: {}'.format(item_id))
+    if availability is None:
+        raise ApiError(502, 'Could not fetch the availability of {}'.format(
+            item_id))
+    return {
+        'info': records.as_dict(info),
+        'availability': records.as_dict(availability),
+        'parts': check_stock.get_sub_parts(availability)
+    }
+
+
+def store_lookup(query):
+    """Returns the stores of a country, or one store by buCode."""
+    ikea_stores = load_config.get_ikea_stores()
+    country = get_param(
+        query, 'country', check_stock.ISC_CONFIG['country_code'])
+    if not ikea_stores.is_valid_country_code(country):
+        raise ApiError(404, 'Unknown country code: {}'.format(country))
+    if 'id' in query:
+        store = ikea_stores.lookup(get_param(query, 'id'), country)
+        if store is None:
+            raise ApiError(404, 'Unknown store: {}'.format(query['id'][0]))
+        return store
+    return {'stores': list(ikea_stores.stores_in(country))}
+
+
+def cache_stats(query):
+    return check_stock.get_cache_stats(check_stock.PRODUCT_CACHE)
+
+
+GET_ROUTES = {
+    '/product-info': product_info,
+    '/stores': store_lookup,
+    '/cache-stats': cache_stats
+}
+
+
+def make_handler(workers):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def answer(self, route, *args):
+            try:
+                self.send_json(200, route(*args))
+            except ApiError as e:
+                self.send_json(e.status, {'error': e.message})
+            except Exception:
+                self.log_error('%s failed', self.path)
+                traceback.print_exc()
+                self.send_json(500, {'error': 'Internal server error'})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            route = GET_ROUTES.get(url.path)
+            if route is None:
+                self.send_json(404, {'error': 'Not found'})
+                return
+            self.answer(route, parse_qs(url.query))
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/stock-check':
+                self.send_json(404, {'error': 'Not found'})
+                return
+            try:
+                size = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                self.send_json(400, {'error': 'Invalid Content-Length'})
+                self.close_connection = True
+                return
+            if size > MAX_BODY_SIZE:
+                self.send_json(413, {'error': 'Request body too large'})
+                self.close_connection = True
+                return
+            try:
+                body = json.loads(self.rfile.read(size) or b'{}')
+            except ValueError:
+                self.send_json(400, {'error': 'Invalid JSON'})
+                return
+            self.answer(stock_check, body, workers)
+
+    return Handler
+
+
+class ApiServer(ThreadingHTTPServer):
+    """
+    Serves the JSON API, evicting the product info cache every
+    EVICT_INTERVAL seconds so it stays within its size cap while the
+    server runs.
+    """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evicted_at = time.monotonic()
+
+    def service_actions(self):
+        super().service_actions()
+        if (check_stock.PRODUCT_CACHE
+                and time.monotonic() - self.evicted_at >= EVICT_INTERVAL):
+            self.evicted_at = time.monotonic()
+            check_stock.PRODUCT_CACHE.evict()
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=4,
+                availability_ttl=DEFAULT_AVAILABILITY_TTL):
+    """
+    Returns an ApiServer answering the JSON API.
+
+    check_stock must be configured, and check_stock.PRODUCT_CACHE set if
+    used. Product info and availability are answered from the
+    process-wide check_stock caches, availability for at most
+    availability_ttl seconds and product info until it expires, see
+    check_stock.expire_product_info.
+    """
+    check_stock.PRODUCT_AVAILABILITY = cache.LRUCache(
+        check_stock.PRODUCT_AVAILABILITY.maxsize, ttl=availability_ttl)
+    check_stock.expire_product_info()
+    # the failure lists are only read by the CLI reports, keep them bounded
+    check_stock.FAILED = collections.deque(maxlen=1000)
+    check_stock.NOT_PUBLISHED = collections.deque(maxlen=1000)
+    # answer at once while the ikea API is failing instead of waiting
+    transport.CIRCUIT_WAIT = False
+
+    return ApiServer((host, port), make_handler(workers))
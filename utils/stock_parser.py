@@ -0,0 +1,126 @@
+from xml.parsers import expat
+
+
+LOCAL_STORE = 'localStore'
+
+
+class LocalStoreParser():
+    """
+    Incremental parser for ikea availability documents.
+
+    Only the `localStore` elements whose `buCode` is in `store_ids` are
+    materialized, using the same dict layout as xmltodict. Every other
+    `localStore` subtree is skipped without building any objects.
+    """
+    def __init__(self, store_ids):
+        self.store_ids = set(store_ids)
+        self.stores = {}
+        self.stats = {
+            'stores': 0,
+            'skipped_stores': 0,
+            'skipped_elements': 0,
+            'skipped_bytes': 0,
+            'total_bytes': 0
+        }
+
+        self._stack = []
+        self._skip_depth = 0
+        self._skip_start = 0
+
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def feed(self, data):
+        """
+        Parses the next chunk of the document.
+        """
+        self.stats['total_bytes'] += len(data)
+        self._parser.Parse(data, False)
+
+    def close(self):
+        """
+        Finishes parsing and returns the parsed stores by buCode.
+        """
+        self._parser.Parse(b'', True)
+        return self.stores
+
+    def _start(self, name, attrs):
+        if self._skip_depth:
+            self._skip_depth += 1
+            self.stats['skipped_elements'] += 1
+            return
+
+        if name == LOCAL_STORE:
+            self.stats['stores'] += 1
+            if attrs.get('buCode') not in self.store_ids:
+                self.stats['skipped_stores'] += 1
+                self.stats['skipped_elements'] += 1
+                self._skip_depth = 1
+                self._skip_start = self._parser.CurrentByteIndex
+                return
+            self._stack.append([name, {}, []])
+        elif self._stack:
+            self._stack.append([name, {}, []])
+        else:
+            # document level elements outside of a localStore
+            return
+
+        node = self._stack[-1][1]
+        for key, value in attrs.items():
+            node['@' + key] = value
+
+    def _end(self, name):
+        if self._skip_depth:
+            self._skip_depth -= 1
+            if not self._skip_depth:
+                self.stats['skipped_bytes'] += (
+                    self._parser.CurrentByteIndex - self._skip_start
+                    + len(name) + 3)
+            return
+
+        if not self._stack:
+            return
+
+        name, node, text = self._stack.pop()
+        text = ''.join(text).strip() or None
+        if node:
+            if text:
+                node['#text'] = text
+            value = node
+        else:
+            value = text
+
+        if not self._stack:
+            self.stores[value['@buCode']] = value
+            return
+
+        parent = self._stack[-1][1]
+        if name in parent:
+            if isinstance(parent[name], list):
+                parent[name].append(value)
+            else:
+                parent[name] = [parent[name], value]
+        else:
+            parent[name] = value
+
+    def _data(self, data):
+        if self._stack and not self._skip_depth:
+            self._stack[-1][2].append(data)
+
+
+def parse_local_stores(data, store_ids):
+    """
+    Parses the `localStore` elements of the requested stores.
+
+    Inputs:
+        data bytes: The availability XML document
+        store_ids [string]: The store buCodes to keep
+
+    Returns: A tuple of ({buCode: localStore dict}, parser stats)
+    """
+    parser = LocalStoreParser(store_ids)
+    parser.feed(data)
+    return parser.close(), parser.stats
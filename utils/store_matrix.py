@@ -0,0 +1,208 @@
+import numpy as np
+
+from termcolor import colored
+
+from utils import check_stock
+
+
+# in-stock confidence codes, ordered so the lowest code wins
+CONFIDENCE_LEVELS = ('LOW', 'MEDIUM', 'HIGH')
+CONFIDENCE_CODES = {
+    level: code for code, level in enumerate(CONFIDENCE_LEVELS)}
+# stores printed by print_summary unless told otherwise
+DEFAULT_TOP = 10
+
+
+class StockMatrix():
+    """
+    The stock of a list at every store of a country as dense store x line
+    arrays.
+
+    A line is a row of the store reports: a product, or a sub-part of a
+    multi-part product. Each array has one row per store in store_ids and
+    one column per line:
+
+        needed: The quantity compared with the stock, see
+            check_stock.build_store_reports
+        available: The available stock, 0 when the store is missing from
+            the availability response
+        confidence: The in-stock confidence code, see CONFIDENCE_CODES,
+            LOW when the store is missing. Sub-parts are HIGH, like in the
+            store reports, only the product's own confidence counts
+        items: The number of items counted in the store's total items
+    """
+    def __init__(self, store_ids, lines):
+        self.store_ids = list(store_ids)
+        self.lines = list(lines)
+        shape = (len(self.store_ids), len(self.lines))
+        self.needed = np.zeros(shape, dtype=np.int64)
+        self.available = np.zeros(shape, dtype=np.int64)
+        self.confidence = np.full(
+            shape, CONFIDENCE_CODES['HIGH'], dtype=np.int8)
+        self.items = np.zeros(shape, dtype=np.int64)
+
+    def units_short(self):
+        """Returns the units missing per store and line."""
+        return np.maximum(self.needed - self.available, 0)
+
+    def get_summary(self):
+        """
+        Computes the report header of every store at once.
+
+        Returns: A dict of arrays with one entry per store: meets_qty_reqs,
+        confidence (codes), lines_short, units_short and total_items
+        """
+        short = self.units_short()
+        lines_short = np.count_nonzero(short, axis=1)
+        if self.lines:
+            confidence = self.confidence.min(axis=1)
+        else:
+            confidence = np.full(
+                len(self.store_ids), CONFIDENCE_CODES['HIGH'], dtype=np.int8)
+        return {
+            'meets_qty_reqs': lines_short == 0,
+            'confidence': confidence,
+            'lines_short': lines_short,
+            'units_short': short.sum(axis=1),
+            'total_items': self.items.sum(axis=1)
+        }
+
+    def rank(self, summary=None):
+        """
+        Returns the store indexes from best to worst.
+
+        Stores that meet every quantity come first, then higher confidence,
+        then fewer units and lines short. Ties keep the store order.
+        """
+        if summary is None:
+            summary = self.get_summary()
+        return np.lexsort((
+            summary['lines_short'],
+            summary['units_short'],
+            -summary['confidence'].astype(np.int64),
+            ~summary['meets_qty_reqs']))
+
+
+def get_lines(products):
+    """
+    Returns the report lines of the products as (product index, part
+    number) tuples, the part number being None for the product itself.
+    """
+    lines = []
+    for i, prod in enumerate(products):
+        lines.append((i, None))
+        for part in check_stock.get_sub_parts(prod['availability']):
+            lines.append((i, part))
+    return lines
+
+
+def build_matrix(products, store_ids):
+    """
+    Fills a StockMatrix from fetched products.
+
+    Inputs:
+        products [dict]: Complete products, see load_parse_all_products
+            and check_stock.is_complete
+        store_ids [string]: The stores, in order
+
+    Returns: A StockMatrix
+    """
+    lines = get_lines(products)
+    matrix = StockMatrix(store_ids, lines)
+    store_index = {store_id: i for i, store_id in enumerate(store_ids)}
+    column = {line: j for j, line in enumerate(lines)}
+
+    for i, prod in enumerate(products):
+        qty = prod['qty_needed']
+        parts = {
+            part_number: {
+                avail.store_id: avail.available
+                for avail in part['availability']}
+            for part_number, part in prod['parts'].items()
+        }
+        j = column[(i, None)]
+        matrix.needed[:, j] = qty
+        matrix.confidence[:, j] = CONFIDENCE_CODES['LOW']
+        for avail in prod['availability']:
+            s = store_index.get(avail.store_id)
+            if s is None:
+                continue
+            matrix.available[s, j] = avail.available
+            matrix.confidence[s, j] = CONFIDENCE_CODES.get(
+                avail.probability, CONFIDENCE_CODES['HIGH'])
+            if not avail.is_multi_product:
+                matrix.items[s, j] = avail.locations[0].qty * qty
+                continue
+            for loc in avail.locations:
+                k = column[(i, loc.part_number)]
+                matrix.needed[s, k] = loc.qty * qty
+                matrix.items[s, k] = loc.qty * qty
+                matrix.available[s, k] = parts[loc.part_number].get(
+                    avail.store_id, 0)
+    return matrix
+
+
+def get_summary_rows(matrix, country_code=None):
+    """
+    Lays out the ranked stores as CSV rows.
+    """
+    summary = matrix.get_summary()
+    rows = [[
+        'Rank',
+        'Store',
+        'Store ID',
+        'Meets Qty Reqs',
+        'In-Stock Confidence',
+        'Lines Short',
+        'Units Short',
+        'Total Items'
+    ]]
+    for rank, s in enumerate(matrix.rank(summary), start=1):
+        store_id = matrix.store_ids[s]
+        rows.append([
+            rank,
+            check_stock.get_store_name(store_id, country_code),
+            store_id,
+            bool(summary['meets_qty_reqs'][s]),
+            CONFIDENCE_LEVELS[summary['confidence'][s]],
+            int(summary['lines_short'][s]),
+            int(summary['units_short'][s]),
+            int(summary['total_items'][s])
+        ])
+    return rows
+
+
+def print_summary(rows, total_price, top=DEFAULT_TOP):
+    """
+    Prints the best ranked stores of get_summary_rows.
+    """
+    stores = rows[1:]
+    meeting = sum(1 for row in stores if row[3])
+    print('\n{} of {} stores meet every quantity, total price {}'.format(
+        meeting, len(stores), total_price))
+    for row in stores[:top]:
+        confcolor = check_stock.color_confidence(row[4])
+        print('{:>3}. {} ({}) Confidence: {}, short {} lines / {} units'
+              .format(row[0], row[1], row[2], colored(row[4], confcolor),
+                      row[5], row[6]))
+    if len(stores) > top:
+        print('... {} more stores in the summary file'.format(
+            len(stores) - top))
+
+
+def save_summary(products, verbose, country_code=None, top=DEFAULT_TOP):
+    """
+    Ranks every store of a country for the products and saves the ranking
+    as out_all_stores_[country].csv, instead of one report per store.
+    """
+    market = check_stock.get_market(country_code)
+    matrix = build_matrix(products, market['store_ids'])
+    rows = get_summary_rows(matrix, market['country_code'])
+    total_price = check_stock.calc_total_price(products)
+
+    print_summary(rows, total_price, top)
+    check_stock.save_file(
+        'out_all_stores_{}.csv'.format(market['country_code']),
+        [['Total Price', total_price], ['\n']] + rows)
+    if verbose:
+        print(colored('\nDone.', 'green'))
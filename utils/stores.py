@@ -1,24 +1,34 @@
+import hashlib
 import json
+import marshal
+import os
+
+
+# bump when the layout of the compiled index changes
+INDEX_VERSION = 2
 
 
 class IkeaStores():
     """Ikea store class"""
     def __init__(self,
                  store_map='stores.json',
-                 country_code='us'
+                 country_code='us',
+                 compiled=True
                  ):
-        self.store_map = get_json_obj(store_map)
+        if compiled:
+            index = load_index(store_map)
+        else:
+            index = build_index(get_json_obj(store_map))
+        self.store_map = index['store_map']
+        self.by_country = index['by_country']
+        self.by_code = index['by_code']
         self.country_code = country_code
 
     def list_country_codes(self):
         """
         Returns the list of countries in the target store map.
         """
-        store_list = []
-        for store in self.store_map:
-            if store['countryCode'] not in store_list:
-                store_list.append(store['countryCode'])
-        return store_list
+        return list(self.by_country)
 
     def get(self):
         """
@@ -26,53 +36,59 @@ class IkeaStores():
         """
 
         # Return all stores that match the country code
-        store_list = []
-        for store in self.store_map:
-            if store['countryCode'] == self.country_code:
-                store_list.append(store)
-        return store_list
+        return list(self.stores_in(self.country_code))
+
+    def stores_in(self, country_code=None):
+        """
+        Returns the stores of a country, defaults to the target country.
+        """
+        return self.by_country.get(country_code or self.country_code, [])
 
-    def get_ids(self):
+    def lookup(self, bu_code, country_code=None):
         """
-        Returns JSON object of store IDs.
+        Returns the store with the given buCode or None.
+
+        buCodes are only unique within a country, so the lookup is done in
+        the target country unless another country code is given.
         """
+        return self.by_code.get((country_code or self.country_code, bu_code))
 
-        store_ids = []
-        for store in self.store_map:
-            if store['countryCode'] == self.country_code:
-                store_ids.append(store['buCode'])
-        return store_ids
+    def get_ids(self, country_code=None):
+        """
+        Returns the store IDs of a country, defaults to the target country.
+        """
+        return [store['buCode'] for store in self.stores_in(country_code)]
 
-    def get_store_names(self, store_ids):
+    def get_store_names(self, store_ids, country_code=None):
         """
         Gets the store name from the store ID
 
         Inputs:
-            store_id int: The store ID
+            store_ids [string]: The store IDs
+            country_code string: The country of the stores
 
-        Returns: The store name
+        Returns: A list of store IDs and names
         """
         store_names = []
         for store_id in store_ids:
-            for store in self.store_map:
-                if store['buCode'] == store_id:
-                    store_names.append(
-                            {
-                                'id': store_id,
-                                'name': store['name']
-                            }
-                        )
+            store = self.lookup(store_id, country_code)
+            if store:
+                store_names.append(
+                        {
+                            'id': store_id,
+                            'name': store['name']
+                        }
+                    )
         return store_names
 
-    def is_valid_store(self, store_id_list):
-        for store in store_id_list:
-            if store in self.get_ids():
-                return True
+    def is_valid_store(self, store_id):
+        """
+        Returns True if the store ID exists in the target country.
+        """
+        return self.lookup(store_id) is not None
 
     def is_valid_country_code(self, code):
-        country_codes = self.list_country_codes()
-        if code in country_codes:
-            return True
+        return code in self.by_country
 
 
 def get_json_obj(file):
@@ -82,6 +98,93 @@ def get_json_obj(file):
     return data
 
 
+def build_index(store_map):
+    """
+    Indexes a store map by country code and by (country code, buCode).
+    """
+    by_country = {}
+    by_code = {}
+    for store in store_map:
+        country = store['countryCode']
+        by_country.setdefault(country, []).append(store)
+        by_code[(country, store['buCode'])] = store
+    return {
+        'store_map': store_map,
+        'by_country': by_country,
+        'by_code': by_code
+    }
+
+
+def index_path(store_map):
+    """Returns the path of the compiled index of a store map."""
+    return store_map + '.index'
+
+
+def file_hash(file):
+    """Returns the sha256 hex digest of a file."""
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compile_index(store_map='stores.json'):
+    """
+    Compiles a store map into an index next to the source file.
+
+    The stores are saved with marshal, which only reads back plain data,
+    unlike pickle, and the lookup tables are rebuilt on load.
+
+    Returns: The index
+    """
+    stat = os.stat(store_map)
+    store_map_obj = get_json_obj(store_map)
+    source = {
+        'version': INDEX_VERSION,
+        'marshal_version': marshal.version,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': file_hash(store_map)
+    }
+    try:
+        with open(index_path(store_map), 'wb') as f:
+            f.write(marshal.dumps(
+                {'source': source, 'store_map': store_map_obj}))
+    except OSError:
+        # read-only checkout, use the index without saving it
+        pass
+    index = build_index(store_map_obj)
+    index['source'] = source
+    return index
+
+
+def load_index(store_map='stores.json'):
+    """
+    Loads the compiled index of a store map.
+
+    The index is rebuilt when it is missing, unreadable, written by
+    another index or marshal version, or when the source file has changed.
+    A changed mtime alone only triggers a hash comparison.
+    """
+    try:
+        with open(index_path(store_map), 'rb') as f:
+            saved = marshal.loads(f.read())
+        source = saved['source']
+        if (source['version'] != INDEX_VERSION
+                or source['marshal_version'] != marshal.version):
+            return compile_index(store_map)
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return compile_index(store_map)
+
+    stat = os.stat(store_map)
+    if source['size'] != stat.st_size:
+        return compile_index(store_map)
+    if source['mtime_ns'] != stat.st_mtime_ns:
+        if source['sha256'] != file_hash(store_map):
+            return compile_index(store_map)
+    index = build_index(saved['store_map'])
+    index['source'] = source
+    return index
+
+
 if __name__ == "__main__":
     stores = IkeaStores(store_map='../stores.json')
     print(stores.get())
@@ -0,0 +1,390 @@
+import random
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.exceptions import ConnectTimeoutError
+
+from utils import profiling, recording
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+# requests per second over all endpoints, 0 disables rate limiting. Leaves
+# the default 4 workers alone unless ikea answers in under 200 ms
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_MAX_RETRIES = 3
+# seconds, doubled on every retry
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+# consecutive failures before an endpoint is blocked
+DEFAULT_CIRCUIT_THRESHOLD = 5
+# seconds before a blocked endpoint is tried again
+DEFAULT_CIRCUIT_RESET = 30.0
+
+# the [HTTP] options of config.ini, see configure()
+HTTP_DEFAULTS = {
+    'pool_size': DEFAULT_POOL_SIZE,
+    'connect_timeout': DEFAULT_CONNECT_TIMEOUT,
+    'read_timeout': DEFAULT_READ_TIMEOUT,
+    'rate_limit': DEFAULT_RATE_LIMIT,
+    'max_retries': DEFAULT_MAX_RETRIES,
+    'backoff': DEFAULT_BACKOFF,
+    'max_backoff': DEFAULT_MAX_BACKOFF,
+    'circuit_threshold': DEFAULT_CIRCUIT_THRESHOLD,
+    'circuit_reset': DEFAULT_CIRCUIT_RESET
+}
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# the only status safe to retry when a request must not be applied twice
+UNAPPLIED_STATUS_CODES = (429,)
+
+HTTPError = requests.HTTPError
+RequestError = requests.RequestException
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised when an endpoint is blocked after repeated failures."""
+
+
+class TokenBucket():
+    """
+    Token bucket rate limiter.
+
+    Allows bursts of up to `burst` requests and `rate` requests per second
+    on average.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker():
+    """
+    Blocks an endpoint for `reset_after` seconds once `threshold`
+    consecutive requests have failed, each request counting once after its
+    retries. After that a single trial request is let through; its result
+    closes or re-opens the circuit. `reopened` tells that a trial failed,
+    i.e. the endpoint is still down.
+    """
+    def __init__(self,
+                 threshold=DEFAULT_CIRCUIT_THRESHOLD,
+                 reset_after=DEFAULT_CIRCUIT_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.reopened = False
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                self._trial = True
+                return True
+            return False
+
+    def retry_in(self):
+        """
+        Returns the seconds until allow() may let a request through again.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            if self._trial:
+                # wait for the result of the trial request
+                return min(1.0, self.reset_after)
+            return max(
+                0, self.reset_after - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.reopened = False
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.reopened = self._trial
+            self._trial = False
+
+
+POOL_SIZE = DEFAULT_POOL_SIZE
+TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+MAX_RETRIES = DEFAULT_MAX_RETRIES
+BACKOFF = DEFAULT_BACKOFF
+MAX_BACKOFF = DEFAULT_MAX_BACKOFF
+CIRCUIT_THRESHOLD = DEFAULT_CIRCUIT_THRESHOLD
+CIRCUIT_RESET = DEFAULT_CIRCUIT_RESET
+RATE_LIMITER = TokenBucket(DEFAULT_RATE_LIMIT)
+# wait for a blocked endpoint to be tried again instead of failing at once
+CIRCUIT_WAIT = True
+
+# see set_archive()
+RECORD_ARCHIVE = None
+REPLAY_ARCHIVE = None
+
+_breakers = {}
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(pool_size=DEFAULT_POOL_SIZE,
+              connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+              read_timeout=DEFAULT_READ_TIMEOUT,
+              rate_limit=DEFAULT_RATE_LIMIT,
+              max_retries=DEFAULT_MAX_RETRIES,
+              backoff=DEFAULT_BACKOFF,
+              max_backoff=DEFAULT_MAX_BACKOFF,
+              circuit_threshold=DEFAULT_CIRCUIT_THRESHOLD,
+              circuit_reset=DEFAULT_CIRCUIT_RESET):
+    """
+    Sets the connection pool, timeouts and request policy of the shared
+    session.
+
+    An existing session is closed and recreated on next use.
+    """
+    global POOL_SIZE, TIMEOUT, MAX_RETRIES, BACKOFF, MAX_BACKOFF
+    global CIRCUIT_THRESHOLD, CIRCUIT_RESET, RATE_LIMITER, _session
+    with _session_lock:
+        POOL_SIZE = pool_size
+        TIMEOUT = (connect_timeout, read_timeout)
+        MAX_RETRIES = max_retries
+        BACKOFF = backoff
+        MAX_BACKOFF = max_backoff
+        CIRCUIT_THRESHOLD = circuit_threshold
+        CIRCUIT_RESET = circuit_reset
+        RATE_LIMITER = TokenBucket(rate_limit)
+        _breakers.clear()
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def set_archive(record=None, replay=None):
+    """
+    Records every response into, or replays every response from, an
+    archive directory (see utils.recording). Replayed runs make no network
+    requests at all.
+    """
+    global RECORD_ARCHIVE, REPLAY_ARCHIVE
+    RECORD_ARCHIVE = recording.Archive(record) if record else None
+    REPLAY_ARCHIVE = recording.Archive(replay) if replay else None
+
+
+def get_session():
+    """
+    Returns the shared keep-alive session, creating it on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def get_endpoint(url):
+    """
+    Returns the endpoint of a url, its host and path without the last
+    segment, e.g. www.ikea.com/us/en/catalog/products
+    """
+    parts = urlsplit(url)
+    return parts.netloc + parts.path.rsplit('/', 1)[0]
+
+
+def get_breaker(endpoint):
+    """
+    Returns the circuit breaker of an endpoint.
+    """
+    with _session_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(
+                CIRCUIT_THRESHOLD, CIRCUIT_RESET)
+        return _breakers[endpoint]
+
+
+def get_backoff(attempt, response=None):
+    """
+    Returns the seconds to wait before the next attempt, exponential
+    backoff with full jitter unless the server sent a Retry-After header.
+    """
+    if response is not None:
+        try:
+            return min(MAX_BACKOFF, float(response.headers['Retry-After']))
+        except (KeyError, ValueError):
+            pass
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+
+
+def is_unsent(error):
+    """
+    Returns True if a request failed before it reached the server, e.g. the
+    connection could not be opened, so it is safe to send it again.
+    """
+    if isinstance(error, (CircuitOpenError, requests.ConnectTimeout)):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def get(url, params=None, headers=None, idempotent=True):
+    """
+    Sends a GET request over the shared session.
+
+    Requests are rate limited, connection errors, timeouts and 429/5xx
+    responses are retried with backoff, and endpoints that keep failing
+    are blocked by a circuit breaker. Requests to a blocked endpoint wait
+    for its trial request, see wait_for_circuit, or raise CircuitOpenError.
+
+    Requests that are not idempotent, e.g. adding to a shopping list, are
+    only retried when they cannot have been applied: when the connection
+    could not be opened (see is_unsent) and on 429. Read timeouts, broken
+    connections and other 5xx responses are raised or returned at once.
+
+    The final response is recorded to, or read from, the archive set by
+    set_archive().
+
+    Returns: The requests.Response
+    """
+    if REPLAY_ARCHIVE:
+        started = time.perf_counter()
+        response = REPLAY_ARCHIVE.load(url, params)
+        profiling.record_request(
+            get_endpoint(url), time.perf_counter() - started,
+            len(response.content))
+        return response
+
+    response = send(url, params, headers, idempotent)
+    if RECORD_ARCHIVE:
+        RECORD_ARCHIVE.save(url, params, response)
+    return response
+
+
+def wait_for_circuit(breaker, endpoint):
+    """
+    Blocks until the circuit breaker lets a request through.
+
+    Raises CircuitOpenError instead of waiting if CIRCUIT_WAIT is off, or
+    once a trial request failed: the endpoint is down, so the requests fail
+    at once until a later trial succeeds, rather than each waiting out a
+    reset.
+    """
+    while not breaker.allow():
+        if not CIRCUIT_WAIT or breaker.reopened:
+            raise CircuitOpenError(
+                'Too many failed requests to {}'.format(endpoint))
+        time.sleep(max(0.01, breaker.retry_in()))
+
+
+def send(url, params=None, headers=None, idempotent=True):
+    """
+    Sends a GET request with the retry, rate limit and circuit breaker
+    policy described in get().
+
+    The circuit breaker counts the request once, after its retries. Each
+    attempt is recorded with the profiler on its own, timed around the
+    request only; waiting for the circuit breaker, the rate limiter and
+    the backoff is timed as the 'request_wait' phase.
+    """
+    endpoint = get_endpoint(url)
+    breaker = get_breaker(endpoint)
+    with profiling.phase('request_wait'):
+        wait_for_circuit(breaker, endpoint)
+    retry_codes = RETRY_STATUS_CODES if idempotent else UNAPPLIED_STATUS_CODES
+
+    for attempt in range(MAX_RETRIES + 1):
+        with profiling.phase('request_wait'):
+            RATE_LIMITER.acquire()
+
+        response = None
+        started = time.perf_counter()
+        try:
+            response = get_session().get(
+                url, params=params, headers=headers, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            profiling.record_request(
+                endpoint, time.perf_counter() - started, 0)
+            if attempt == MAX_RETRIES or not (idempotent or is_unsent(e)):
+                breaker.record_failure()
+                raise
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        else:
+            profiling.record_request(
+                endpoint, time.perf_counter() - started,
+                len(response.content))
+            if response.status_code not in RETRY_STATUS_CODES:
+                breaker.record_success()
+                return response
+            if (attempt == MAX_RETRIES
+                    or response.status_code not in retry_codes):
+                breaker.record_failure()
+                return response
+
+        with profiling.phase('request_wait'):
+            time.sleep(get_backoff(attempt, response))
+
+
+def fetch(url, params=None, headers=None):
+    """
+    Sends a GET request over the shared session.
+
+    Raises HTTPError for 4xx/5xx responses.
+
+    Returns: The response body as bytes
+    """
+    response = get(url, params=params, headers=headers)
+    response.raise_for_status()
+    return response.content
+
+
+def close():
+    """
+    Closes the shared session and its pooled connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
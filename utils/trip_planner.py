@@ -0,0 +1,526 @@
+import numpy as np
+
+from termcolor import colored
+
+from utils import check_stock
+from utils.store_matrix import CONFIDENCE_CODES
+
+
+# in-stock confidence a store's stock must have to be planned with
+DEFAULT_MIN_CONFIDENCE = 'MEDIUM'
+# largest number of candidate stores searched exactly, see plan
+EXACT_MAX_STORES = 64
+# branch and bound nodes searched before settling for the best plan found
+MAX_NODES = 50000
+
+
+def group_products(products):
+    """
+    Merges the products listed more than once.
+
+    Returns: A list of (product, qty, notes) with the first product of
+    each article, the summed qty_needed and the distinct notes
+    """
+    groups = {}
+    for prod in products:
+        if prod['id'] not in groups:
+            groups[prod['id']] = [prod, 0, []]
+        group = groups[prod['id']]
+        group[1] += prod['qty_needed']
+        if prod['notes'] and prod['notes'] not in group[2]:
+            group[2].append(prod['notes'])
+    return [(prod, qty, '; '.join(notes))
+            for prod, qty, notes in groups.values()]
+
+
+def is_confident(avail, min_code):
+    """Returns True if a StoreAvailability is at least at min_code."""
+    return CONFIDENCE_CODES.get(avail.probability, 0) >= min_code
+
+
+def get_stock(products, store_ids, min_confidence=DEFAULT_MIN_CONFIDENCE):
+    """
+    Returns the stock of every store and what each product takes of it.
+
+    Inputs:
+        products [(product, qty, notes)]: see group_products
+        store_ids [string]: The candidate stores
+        min_confidence string: Stock at a lower in-stock confidence does
+            not count
+
+    Returns: (stock, recipes)
+        stock [{article id: units}]: Per store, the units of the products
+            and sub-parts in stock at min_confidence. A sub-part has a
+            single stock per store, shared by all the products using it
+            and by the sub-part itself when it is also on the list
+        recipes [[{article id: units}]]: Per store and product, the units
+            of stock one product takes: the product itself and, for a
+            multi-part product, each of its sub-parts. None where the
+            product or one of its sub-parts is not in stock at
+            min_confidence
+    """
+    min_code = CONFIDENCE_CODES[min_confidence]
+    store_index = {store_id: i for i, store_id in enumerate(store_ids)}
+    stock = [{} for store_id in store_ids]
+    recipes = [[None] * len(products) for store_id in store_ids]
+
+    def add_stock(s, item_id, avail):
+        if not is_confident(avail, min_code):
+            return False
+        stock[s].setdefault(item_id, max(avail.available, 0))
+        return True
+
+    for p, (prod, qty, notes) in enumerate(products):
+        parts = {
+            part_number: {
+                avail.store_id: avail for avail in part['availability']}
+            for part_number, part in prod['parts'].items()
+        }
+        for avail in prod['availability']:
+            s = store_index.get(avail.store_id)
+            if s is None or not add_stock(s, prod['id'], avail):
+                continue
+            recipe = {prod['id']: 1}
+            if avail.is_multi_product:
+                for loc in avail.locations:
+                    part = parts[loc.part_number].get(avail.store_id)
+                    if part is None or not add_stock(
+                            s, loc.part_number, part):
+                        recipe = None
+                        break
+                    if loc.qty:
+                        recipe[loc.part_number] = (
+                            recipe.get(loc.part_number, 0) + loc.qty)
+            recipes[s][p] = recipe
+    return stock, recipes
+
+
+def get_supply(stock, recipe):
+    """Returns how many products a recipe can make from a store's stock."""
+    if recipe is None:
+        return 0
+    return min(stock.get(item_id, 0) // units
+               for item_id, units in recipe.items())
+
+
+def get_capacity(stock, recipes):
+    """
+    Returns how many of each product every store can supply on its own.
+
+    Inputs:
+        stock, recipes: see get_stock
+
+    Returns: A store x product int array. A multi-part product is limited
+    by its scarcest sub-part at the store. The stock of a sub-part shared
+    by several products is counted for each of them, so the capacity is
+    an upper bound and split_quantities allocates the actual stock.
+    """
+    capacity = np.zeros(
+        (len(recipes), len(recipes[0]) if recipes else 0), dtype=np.int64)
+    for s, store_recipes in enumerate(recipes):
+        for p, recipe in enumerate(store_recipes):
+            capacity[s, p] = get_supply(stock[s], recipe)
+    return capacity
+
+
+def get_shared(recipes, stores):
+    """
+    Returns the article ids whose stock is taken by more than one product
+    at one of the stores.
+    """
+    shared = set()
+    for s in stores:
+        users = {}
+        for recipe in recipes[s]:
+            for item_id in recipe or ():
+                users[item_id] = users.get(item_id, 0) + 1
+        shared.update(i for i, count in users.items() if count > 1)
+    return sorted(shared)
+
+
+def get_dominance(capacity):
+    """
+    Returns a store x store bool array, True where store a supplies at
+    least as much as store b of every product. Of equal stores only the
+    first dominates the others.
+    """
+    covers = (capacity[:, None, :] >= capacity[None, :, :]).all(axis=2)
+    equal = covers & covers.T
+    first = np.triu(np.ones(equal.shape, dtype=bool), k=1)
+    return covers & (~equal | first)
+
+
+def lower_bound(capacity, remaining):
+    """
+    Returns the fewest stores of capacity that could supply remaining.
+
+    Each product on its own needs at least as many stores as it takes of
+    its largest suppliers, and the whole list at least as many as it takes
+    of the stores supplying most units of it. The bound is the largest of
+    these counts. Returns None if the stores cannot supply remaining at all.
+    """
+    needed = remaining > 0
+    if not needed.any():
+        return 0
+    if not len(capacity):
+        return None
+    cap = np.minimum(capacity[:, needed], remaining[needed])
+    supply = -np.sort(-cap, axis=0).cumsum(axis=0)
+    if (supply[-1] < remaining[needed]).any():
+        return None
+    per_product = (supply < remaining[needed]).sum(axis=0).max() + 1
+    units = -np.sort(-cap.sum(axis=1)).cumsum()
+    total = (units < remaining[needed].sum()).sum() + 1
+    return int(max(per_product, total))
+
+
+def greedy_cover(capacity, target):
+    """
+    Picks the store supplying most of what is still missing until target
+    is covered, then drops the stores the others make redundant.
+
+    Returns: The list of store indexes, in order of picking
+    """
+    remaining = target.copy()
+    chosen = []
+    while remaining.any():
+        gain = np.minimum(capacity, remaining).sum(axis=1)
+        gain[chosen] = -1
+        s = int(gain.argmax())
+        if gain[s] <= 0:
+            break
+        chosen.append(s)
+        remaining = np.maximum(remaining - capacity[s], 0)
+
+    for s in reversed(list(chosen)):
+        others = [o for o in chosen if o != s]
+        if (capacity[others].sum(axis=0) >= target).all():
+            chosen = others
+    return chosen
+
+
+class BranchAndBound():
+    """
+    Exact search for the fewest stores covering target.
+
+    Stores are added one product at a time: the missing product with the
+    fewest candidate suppliers must come from one of them, so the search
+    branches on those only, biggest supplier first. Stores tried in an
+    earlier branch are left out of the later ones, so no combination is
+    visited twice. A plan with a store but without a store dominating it,
+    see get_dominance, is never better than the plan with the two swapped,
+    so leaving out a store also leaves out the stores it dominates.
+    Branches that cannot beat the best plan, see lower_bound, are cut.
+    """
+    def __init__(self, capacity, target, best, max_nodes=MAX_NODES):
+        self.capacity = capacity
+        self.target = target
+        self.dominance = get_dominance(capacity)
+        self.best = list(best)
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.complete = True
+
+    def search(self, chosen, remaining, candidates):
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            self.complete = False
+            return
+        if not remaining.any():
+            if len(chosen) < len(self.best):
+                self.best = list(chosen)
+            return
+        if len(chosen) + 1 >= len(self.best):
+            return
+
+        bound = lower_bound(self.capacity[candidates], remaining)
+        if bound is None or len(chosen) + bound >= len(self.best):
+            return
+
+        cap = self.capacity[candidates]
+        suppliers = (cap > 0) & (remaining > 0)
+        counts = suppliers.sum(axis=0)
+        counts[remaining == 0] = len(candidates) + 1
+        product = int(counts.argmin())
+        gain = np.minimum(cap, remaining).sum(axis=1)
+        branches = [candidates[i] for i in np.argsort(-gain, kind='stable')
+                    if suppliers[i, product]]
+
+        left = np.zeros(len(self.capacity), dtype=bool)
+        left[candidates] = True
+        for s in branches:
+            if not left[s]:
+                # dominated by a store left out before
+                continue
+            left[s] = False
+            chosen.append(s)
+            self.search(
+                chosen, np.maximum(remaining - self.capacity[s], 0),
+                np.flatnonzero(left))
+            chosen.pop()
+            if not self.complete:
+                return
+            left &= ~self.dominance[s]
+
+    def run(self):
+        """
+        Returns the fewest stores found, as store indexes.
+        """
+        candidates = np.arange(len(self.capacity))
+        self.search([], self.target.copy(), candidates)
+        return self.best
+
+
+def take_stock(stock, recipes, remaining, split, order):
+    """
+    Takes as much of remaining as the store's stock allows, product by
+    product in order, and records it in split, the store's row of the
+    split.
+
+    Returns: The units taken
+    """
+    taken = 0
+    for p in order:
+        if not remaining[p]:
+            continue
+        buy = min(int(remaining[p]), get_supply(stock, recipes[p]))
+        if buy <= 0:
+            continue
+        for item_id, units in recipes[p].items():
+            stock[item_id] -= buy * units
+        split[p] += buy
+        remaining[p] -= buy
+        taken += buy
+    return taken
+
+
+def split_quantities(capacity, stock, recipes, target, chosen):
+    """
+    Splits target among the chosen stores, taking as much as possible from
+    the stores that supply most of the list.
+
+    The stock of a store is shared by its products, see get_stock, the
+    products with the fewest suppliers take from it first. When a shared
+    sub-part runs out, the rest is taken from the other stores of
+    capacity, biggest supplier of what is missing first.
+
+    Returns: (split, stores)
+        split: A store x product int array of the quantities per store
+        stores [int]: The store indexes the split takes from, the chosen
+            stores first
+    """
+    split = np.zeros_like(capacity)
+    stock = [dict(store) for store in stock]
+    order = sorted(chosen, key=lambda s: -np.minimum(
+        capacity[s], target).sum())
+    products = np.argsort((capacity > 0).sum(axis=0), kind='stable')
+    remaining = target.copy()
+    stores = []
+    for s in order:
+        if take_stock(stock[s], recipes[s], remaining, split[s], products):
+            stores.append(s)
+
+    others = [s for s in range(len(capacity)) if s not in chosen]
+    while remaining.any() and others:
+        gain = np.minimum(capacity[others], remaining).sum(axis=1)
+        if gain.max() <= 0:
+            break
+        s = others.pop(int(gain.argmax()))
+        if take_stock(stock[s], recipes[s], remaining, split[s], products):
+            stores.append(s)
+    return split, stores
+
+
+def plan(products, store_ids, min_confidence=DEFAULT_MIN_CONFIDENCE,
+         exact_max_stores=EXACT_MAX_STORES, max_nodes=MAX_NODES):
+    """
+    Finds the fewest stores to visit to buy the list.
+
+    Inputs:
+        products [dict]: see load_parse_all_products. Products left out of
+            the reports, see check_stock.get_left_out_reason, are not
+            planned
+        store_ids [string]: The candidate stores
+        min_confidence string: LOW, MEDIUM or HIGH, see get_stock
+
+    The greedy plan is always computed. When at most exact_max_stores
+    stores have any of the products, it is improved by an exact branch and
+    bound search of at most max_nodes nodes. The search counts the stock
+    of a shared sub-part for each product using it. When the stock runs
+    out once shared, the split adds stores and the plan is not optimal.
+
+    Returns: A dict
+        {
+            'products': [(product, qty, notes)],
+            'store_ids': ['215', ...],
+            'split': store x product int array of the qty to buy,
+            'stores': [store indexes to visit, most useful first],
+            'short': product int array of the qty no store can supply,
+            'optimal': True if the plan has the fewest stores possible,
+            'shared': [article ids taken by several products at a store],
+            'left_out': [(product, qty, notes, reason)] not planned
+        }
+    """
+    grouped = []
+    left_out = []
+    for prod, qty, notes in group_products(products):
+        reason = check_stock.get_left_out_reason(prod)
+        if reason:
+            left_out.append((prod, qty, notes, reason))
+        else:
+            grouped.append((prod, qty, notes))
+    stock, recipes = get_stock(grouped, store_ids, min_confidence)
+    capacity = get_capacity(stock, recipes)
+    demand = np.array([qty for prod, qty, notes in grouped], dtype=np.int64)
+    capacity = np.minimum(capacity, demand)
+    target = np.minimum(demand, capacity.sum(axis=0))
+
+    candidates = np.flatnonzero(capacity.any(axis=1))
+    cap = capacity[candidates]
+    chosen = greedy_cover(cap, target)
+    optimal = len(chosen) <= 1
+    if not optimal and len(candidates) <= exact_max_stores:
+        bnb = BranchAndBound(cap, target, chosen, max_nodes)
+        chosen = bnb.run()
+        optimal = bnb.complete
+    elif not optimal:
+        bound = lower_bound(cap, target)
+        optimal = bound is not None and bound >= len(chosen)
+
+    split = np.zeros_like(capacity)
+    split[candidates], stores = split_quantities(
+        cap, [stock[s] for s in candidates],
+        [recipes[s] for s in candidates], target, chosen)
+    visits = sorted((int(candidates[s]) for s in stores),
+                    key=lambda s: -split[s].sum())
+    short = demand - split.sum(axis=0)
+    if len(stores) > len(chosen) or (short > demand - target).any():
+        # a shared sub-part ran out, the search counted it per product
+        optimal = False
+    return {
+        'products': grouped,
+        'store_ids': list(store_ids),
+        'split': split,
+        'stores': visits,
+        'short': short,
+        'optimal': optimal,
+        'shared': get_shared(recipes, visits),
+        'left_out': left_out
+    }
+
+
+def get_plan_rows(trip, country_code=None):
+    """
+    Lays out a trip plan as CSV rows, one block of rows per store and the
+    products no store can supply, or that were left out, at the end.
+    """
+    rows = [
+        ['Stores To Visit', len(trip['stores'])],
+        ['Fewest Stores Possible', trip['optimal']],
+        ['Shared Stock', ', '.join(trip['shared'])],
+        ['\n'],
+        [
+            'Store',
+            'Store ID',
+            'Part Number',
+            'Description',
+            'Location',
+            'Qty',
+            'Qty Available',
+            'In-Stock Confidence',
+            'Unit Price',
+            'Notes'
+        ]
+    ]
+    for s in trip['stores']:
+        store_id = trip['store_ids'][s]
+        store_name = check_stock.get_store_name(store_id, country_code)
+        for p, (prod, qty, notes) in enumerate(trip['products']):
+            buy = int(trip['split'][s, p])
+            if not buy:
+                continue
+            avail = next(a for a in prod['availability']
+                         if a.store_id == store_id)
+            info = prod['info']
+            if not avail.is_multi_product:
+                rows.append([
+                    store_name, store_id, prod['id'], info.description,
+                    avail.locations[0].location, buy, avail.available,
+                    avail.probability, info.price, notes])
+                continue
+            rows.append([
+                store_name, store_id, prod['id'], info.description,
+                'Multi-Part Product. See Below:', buy, avail.available,
+                avail.probability, info.price, notes])
+            for loc in avail.locations:
+                part = prod['parts'][loc.part_number]
+                part_avail = check_stock.get_part_availability(
+                    part, store_id)
+                rows.append([
+                    store_name, store_id, loc.part_number,
+                    part['info'].description, loc.location, buy * loc.qty,
+                    part_avail.available, part_avail.probability,
+                    part['info'].price, 'Part of ' + prod['id']])
+
+    for p, (prod, qty, notes) in enumerate(trip['products']):
+        short = int(trip['short'][p])
+        if short:
+            rows.append([
+                'Not Covered', '', prod['id'], prod['info'].description,
+                '', short, '', '', prod['info'].price,
+                'NOT ENOUGH QTY! ' + notes])
+    for prod, qty, notes, reason in trip['left_out']:
+        description = price = ''
+        if prod['info'] != "Not available":
+            description = prod['info'].description
+            price = prod['info'].price
+        rows.append([
+            'Not Covered', '', prod['id'], description, '', qty, '', '',
+            price, '{}! {}'.format(reason.upper(), notes).strip()])
+    return rows
+
+
+def print_plan(trip, country_code=None):
+    """
+    Prints the stores of a trip plan and what to buy where.
+    """
+    if not trip['stores']:
+        print(colored('\nNo store has any of the items in stock', 'red'))
+    else:
+        print('\nVisit {} store{}{}:'.format(
+            len(trip['stores']), 's' if len(trip['stores']) > 1 else '',
+            '' if trip['optimal'] else ' (best plan found, may not be the'
+            ' fewest)'))
+    for s in trip['stores']:
+        store_id = trip['store_ids'][s]
+        buys = ['{} x{}'.format(prod['id'], int(trip['split'][s, p]))
+                for p, (prod, qty, notes) in enumerate(trip['products'])
+                if trip['split'][s, p]]
+        print('  {} ({}): {}'.format(
+            check_stock.get_store_name(store_id, country_code), store_id,
+            ', '.join(buys)))
+    short = ['{} x{}'.format(prod['id'], int(trip['short'][p]))
+             for p, (prod, qty, notes) in enumerate(trip['products'])
+             if trip['short'][p]]
+    if short:
+        print(colored('Not enough stock in any store combination: '
+                      + ', '.join(short), 'red'))
+    if trip['shared']:
+        print(colored('Stock shared by several items, planned once: '
+                      + ', '.join(trip['shared']), 'yellow'))
+    for prod, qty, notes, reason in trip['left_out']:
+        print(colored('Not planned, {} x{}: {}'.format(
+            prod['id'], qty, reason), 'red'))
+
+
+def save_plan(products, output, min_confidence=DEFAULT_MIN_CONFIDENCE,
+              country_code=None):
+    """
+    Plans the trip over the stores of a country, prints it and saves it
+    as CSV rows to output.
+    """
+    market = check_stock.get_market(country_code)
+    trip = plan(products, market['store_ids'], min_confidence)
+    print_plan(trip, market['country_code'])
+    check_stock.save_file(output, get_plan_rows(trip, market['country_code']))
+    return trip
@@ -0,0 +1,280 @@
+import datetime
+import json
+import time
+
+from termcolor import colored
+
+from utils import check_stock
+
+
+# minutes between two polls of an item, see get_poll_interval
+DEFAULT_MIN_INTERVAL = 5.0
+DEFAULT_MAX_INTERVAL = 180.0
+# days around a restock or forecast date in which an item is polled often
+RESTOCK_WINDOW_DAYS = 2
+
+
+def parse_date(value):
+    """Returns the date of an ISO formatted date(time) string, or None."""
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def get_dates(avail):
+    """Returns the restock and forecast dates of a StoreAvailability."""
+    dates = [parse_date(avail.restock_date)]
+    for f in avail.forecast or ():
+        dates.append(parse_date(f.get('validDate')))
+    return [d for d in dates if d]
+
+
+def get_poll_interval(availabilities, today, min_interval, max_interval):
+    """
+    Returns the minutes until an item should be polled again.
+
+    Inputs:
+        availabilities [[StoreAvailability]]: The availability of the item
+            and of its sub-parts, None when it could not be fetched
+        today date: The current date
+        min_interval, max_interval float: The interval bounds in minutes
+
+    Items that could not be fetched, and items that are LOW or out of stock
+    somewhere with a restock or forecast date within RESTOCK_WINDOW_DAYS,
+    are polled every min_interval. Other LOW, out of stock or MEDIUM items
+    are polled halfway on a log scale, items at HIGH confidence everywhere
+    every max_interval.
+    """
+    medium = (min_interval * max_interval) ** 0.5
+    window = today + datetime.timedelta(days=RESTOCK_WINDOW_DAYS)
+    interval = max_interval
+    for availability in availabilities:
+        if availability is None:
+            return min_interval
+        for avail in availability:
+            if avail.probability == 'LOW' or avail.available == 0:
+                if any(d <= window for d in get_dates(avail)):
+                    return min_interval
+                interval = min(interval, medium)
+            elif avail.probability != 'HIGH':
+                interval = min(interval, medium)
+    return interval
+
+
+def get_item_changes(old_rows, new_rows):
+    """
+    Returns the items of a store report whose stock or in-stock confidence
+    changed, as [{'id', 'available': [old, new], 'probability': [old, new]}]
+    """
+    old = {row[0]: (row[4], row[5]) for row in old_rows}
+    changes = []
+    seen = set()
+    for row in new_rows:
+        before = old.get(row[0], (None, None))
+        if before != (row[4], row[5]) and row[0] not in seen:
+            seen.add(row[0])
+            changes.append({
+                'id': row[0],
+                'available': [before[0], row[4]],
+                'probability': [before[1], row[5]]
+            })
+    return changes
+
+
+class Watcher():
+    """
+    Polls the availability of a list of items and keeps the store reports
+    of every configured country up to date.
+
+    Product info stays in the check_stock caches until it expires, see
+    check_stock.expire_product_info; the availability of an item is only
+    dropped from the cache and fetched again when the item is due, see
+    get_poll_interval. A store report is
+    only rewritten, and an event emitted, when its contents change.
+    """
+    def __init__(self, items, verbose=False, workers=1,
+                 min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, events_path=None):
+        self.items = list(items)
+        self.verbose = verbose
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.events_path = events_path
+        self.cycles = 0
+        # item id -> time.monotonic() of its next poll
+        self.next_poll = {}
+        # store id -> (file rows, item rows) of the report last written
+        self.reports = {}
+
+    def get_due(self, now):
+        """Returns the ids of the items due for a poll."""
+        due = []
+        for item in self.items:
+            if (self.next_poll.get(item['id'], 0) <= now
+                    and item['id'] not in due):
+                due.append(item['id'])
+        return due
+
+    def invalidate(self, item_ids):
+        """Drops the cached availability of the items and their sub-parts."""
+        for country_code in check_stock.MARKETS:
+            for item_id in item_ids:
+                key = check_stock.cache_key(item_id, country_code)
+                availability = check_stock.PRODUCT_AVAILABILITY.get(key)
+                for part in check_stock.get_sub_parts(availability):
+                    check_stock.PRODUCT_AVAILABILITY.delete(
+                        check_stock.cache_key(part, country_code))
+                check_stock.PRODUCT_AVAILABILITY.delete(key)
+
+    def fetch(self):
+        """
+        Returns the products of the list per country, fetching what is not
+        cached, as {country_code: [product]}
+        """
+        del check_stock.FAILED[:]
+        del check_stock.NOT_PUBLISHED[:]
+        products = {}
+        for country_code in check_stock.MARKETS:
+            if self.verbose and len(check_stock.MARKETS) > 1:
+                print('\nStock in {}:'.format(country_code))
+            products[country_code] = check_stock.load_parse_all_products(
+                self.items, self.verbose, self.workers, country_code,
+                show_stock=self.verbose)
+
+        # unpublished items will not come back, stop asking for them
+        if check_stock.NOT_PUBLISHED:
+            print(colored(
+                'No longer sold, stops watching: '
+                + ', '.join(sorted(set(check_stock.NOT_PUBLISHED))),
+                'red'))
+            self.items = [i for i in self.items
+                          if i['id'] not in check_stock.NOT_PUBLISHED]
+            for item_id in check_stock.NOT_PUBLISHED:
+                self.next_poll.pop(item_id, None)
+        several = len(products) > 1
+        return {
+            country_code: check_stock.remove_failed(
+                country_products, country_code if several else None)
+            for country_code, country_products in products.items()
+        }
+
+    def schedule(self, products, due, now):
+        """Sets the next poll of the items that were just polled."""
+        today = datetime.date.today()
+        by_id = {}
+        for country_code, country_products in products.items():
+            for p in country_products:
+                by_id.setdefault(p['id'], {})[country_code] = p
+        watched = {item['id'] for item in self.items}
+        for item_id in due:
+            if item_id not in watched:
+                # no longer sold, see fetch
+                continue
+            polled = by_id.get(item_id, {})
+            if len(polled) < len(products):
+                # failed in a country, try again soon
+                interval = self.min_interval
+            else:
+                availabilities = []
+                for product in polled.values():
+                    availabilities.append(product['availability'])
+                    availabilities += [
+                        part['availability']
+                        for part in product.get('parts', {}).values()]
+                interval = get_poll_interval(
+                    availabilities, today, self.min_interval,
+                    self.max_interval)
+            self.next_poll[item_id] = now + interval * 60
+
+    def emit(self, event):
+        """Prints an event and appends it to the events file, if any."""
+        for change in event['changes']:
+            print('{} {}: {} qty {} -> {}, confidence {} -> {}'.format(
+                event['time'], event['store_name'], change['id'],
+                change['available'][0], change['available'][1],
+                change['probability'][0], change['probability'][1]))
+        if self.events_path:
+            with open(self.events_path, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+
+    def update_reports(self, products):
+        """
+        Rewrites the reports of the stores whose contents changed.
+
+        Inputs:
+            products {country_code: [product]}: see fetch
+
+        Returns: The number of reports written
+        """
+        written = 0
+        reports = []
+        for country_code, country_products in products.items():
+            reports += check_stock.build_store_reports(
+                country_products, country_code)
+        for report in reports:
+            rows = check_stock.get_report_rows(report)
+            previous = self.reports.get(report['store_id'])
+            if previous and rows == previous[0]:
+                continue
+            check_stock.save_file(
+                'out_' + str(report['store_name']) + '.csv', rows)
+            written += 1
+            self.reports[report['store_id']] = (rows, report['rows'])
+            if previous is None:
+                continue
+
+            changes = get_item_changes(previous[1], report['rows'])
+            if changes:
+                self.emit({
+                    'time': datetime.datetime.now().isoformat(
+                        timespec='seconds'),
+                    'store_id': report['store_id'],
+                    'store_name': report['store_name'],
+                    'changes': changes
+                })
+        return written
+
+    def cycle(self):
+        """
+        Polls the due items and updates the reports.
+
+        Returns: The number of items polled
+        """
+        now = time.monotonic()
+        due = self.get_due(now)
+        if not due:
+            return 0
+        self.invalidate(due)
+        products = self.fetch()
+        self.schedule(products, due, now)
+        self.update_reports(products)
+        self.cycles += 1
+        if self.verbose:
+            print('\nPolled {} of {} items'.format(len(due), len(self.items)))
+        return len(due)
+
+    def sleep_time(self):
+        """Returns the seconds until the next item is due."""
+        if not self.next_poll:
+            return 0
+        return max(0, min(self.next_poll.values()) - time.monotonic())
+
+    def run(self, cycles=0):
+        """
+        Polls until interrupted, or for a number of cycles, or until no
+        item is left to watch.
+        """
+        try:
+            while not cycles or self.cycles < cycles:
+                if not self.items:
+                    print(colored('No items left to watch', 'red'))
+                    break
+                self.cycle()
+                if cycles and self.cycles >= cycles:
+                    break
+                time.sleep(self.sleep_time())
+        except KeyboardInterrupt:
+            print('\nStopped watching')
+